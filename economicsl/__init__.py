@@ -1,25 +1,155 @@
-from typing import List, Deque, Any
+from typing import List, Deque, Any, Dict, Iterator, Callable, Optional, Iterable
 from collections import deque
+from operator import methodcaller
+from time import perf_counter
+import heapq
 import logging
 
 from .accounting import FastLedger
-from .messages import AbstractMessage, Obligation, GoodMessage
+from .exposures import ExposureIndex
+from .messages import AbstractMessage, Obligation, GoodMessage, ObligationSchedule
 from .accounting import AccountType  # NOQA
-from .abce import NotEnoughGoods  # NOQA
+from .abce import NotEnoughGoods, eps  # NOQA
+
+__version__ = "0.2"
+
+
+class Phase:
+    """
+    A phase of the tick pipeline of a Simulation.
+    A per-agent phase calls `action(agent)` for every agent, otherwise
+    `action()` is called once per tick. Consecutive per-agent phases that are
+    `independent`, i.e. that only touch the agent they are called on, are
+    fused into a single pass over the agents. `skip(agent)` returns True for
+    the agents that have nothing to do in this phase.
+    """
+
+    __slots__ = "name", "action", "per_agent", "independent", "skip"
+
+    def __init__(
+        self,
+        name: str,
+        action: Callable,
+        per_agent: bool = True,
+        independent: bool = False,
+        skip: Optional[Callable[[Any], bool]] = None,
+    ) -> None:
+        self.name = name
+        self.action = action
+        self.per_agent = per_agent
+        self.independent = independent
+        self.skip = skip
+
+
+def _is_fusable(phase: Phase) -> bool:
+    return phase.per_agent and phase.independent
+
+
+def _has_nothing_to_step(agent) -> bool:
+    # Agents that override step() may have more to do than their mailbox
+    return type(agent).step is Agent.step and (
+        not agent.alive or agent.mailbox.is_empty()
+    )
 
 
 class Simulation:
     # Disabled because sometimes the child class needs extra attributes
     # __slots__ = 'time', 'postbox'
 
+    # Class attributes, so that the subclasses whose __init__ doesn't call
+    # this one still have them
+    # See economicsl.trace.TraceRecorder
+    recorder: Any = None
+    # See track_exposures()
+    exposures: Optional[ExposureIndex] = None
+
     def __init__(self) -> None:
         self.time = 0
         self.postbox: Deque[Any] = deque()
+        # The model phases of the tick pipeline, see add_phase()
+        self.phases: List[Phase] = []
+        # Cumulative time spent in each (fused) phase, in seconds
+        self.phase_timings: Dict[str, float] = {}
+        self._pipeline: Optional[List[List[Phase]]] = None
+
+    def add_phase(
+        self,
+        name: str,
+        action: Optional[Callable] = None,
+        per_agent: bool = True,
+        independent: bool = False,
+        skip: Optional[Callable[[Any], bool]] = None,
+    ) -> None:
+        """
+        Register a model phase of the tick. The phases run in the order they
+        are registered, followed by Agent.step, process_postbox and
+        advance_time. If `action` is not given, the agent method called `name`
+        is used; an action called once per tick (`per_agent=False`) has to be
+        given.
+        """
+        if action is None:
+            if not per_agent:
+                raise ValueError("Phase %s: an action is required when per_agent is False" % name)
+            action = methodcaller(name)
+        self.phases.append(Phase(name, action, per_agent, independent, skip))
+        self._pipeline = None
+
+    def get_pipeline(self) -> List[List[Phase]]:
+        """
+        The phases of a tick, grouped into the passes that run_tick() makes.
+        """
+        if self._pipeline is None:
+            phases = self.phases + [
+                Phase("step", methodcaller("step"), skip=_has_nothing_to_step),
+                Phase("process_postbox", self.process_postbox, per_agent=False),
+                Phase("advance_time", self.advance_time, per_agent=False),
+            ]
+            pipeline: List[List[Phase]] = []
+            for phase in phases:
+                if pipeline and _is_fusable(phase) and _is_fusable(pipeline[-1][-1]):
+                    pipeline[-1].append(phase)
+                else:
+                    pipeline.append([phase])
+            self._pipeline = pipeline
+        return self._pipeline
+
+    def run_tick(self, agents: Iterable[Any]) -> None:
+        if not isinstance(agents, (list, tuple)):
+            agents = list(agents)
+        timings = self.phase_timings
+        for group in self.get_pipeline():
+            start = perf_counter()
+            if not group[0].per_agent:
+                group[0].action()
+            elif len(group) == 1:
+                action = group[0].action
+                skip = group[0].skip
+                for agent in agents:
+                    if skip is None or not skip(agent):
+                        action(agent)
+            else:
+                for agent in agents:
+                    for phase in group:
+                        if phase.skip is None or not phase.skip(agent):
+                            phase.action(agent)
+            name = "+".join(phase.name for phase in group)
+            timings[name] = timings.get(name, 0.0) + perf_counter() - start
+
+    def run(self, agents: Iterable[Any], ticks: int) -> None:
+        agents = list(agents)
+        for _ in range(ticks):
+            self.run_tick(agents)
 
     def advance_time(self) -> None:
         self.time += 1
 
     def process_postbox(self):
+        if self.recorder is not None:
+            # A trace that can't be written must not change the simulation
+            try:
+                self.recorder.record(self.time, self.postbox)
+            except Exception:
+                logging.exception("Failed to record the messages of tick %d", self.time)
         for recipient, msg in self.postbox:
             recipient.receive(msg)
         self.postbox.clear()
@@ -27,6 +157,22 @@ class Simulation:
     def get_time(self) -> int:
         return self.time
 
+    def track_exposures(self) -> None:
+        """
+        Start indexing the contracts and obligations of every agent, so that
+        kill_agent() can propagate a default in O(degree). Contracts are
+        indexed as they are added with Agent.add.
+        Once the index is on, agents must be killed with kill_agent(), since
+        Mailbox.step no longer drops the obligations of dead agents.
+        """
+        self.exposures = ExposureIndex()
+
+    def kill_agent(self, agent, write_down: Optional[Callable[[Any, Any], None]] = None) -> None:
+        if self.exposures is None:
+            agent.alive = False
+        else:
+            self.exposures.kill(agent, write_down)
+
 
 class Messenger:
     __slots__ = "mailbox", "postbox"
@@ -39,11 +185,22 @@ class Messenger:
         self.postbox.append((recipient, content))
         if isinstance(content, Obligation):
             self.mailbox.add_to_obligation_outbox(content)
+            exposures = content.simulation.exposures
+            if exposures is not None:
+                exposures.add_obligation(content)
         # Else, is a cash
 
     def send_obligation(self, recipient, obligation: Obligation) -> None:
         self.send(recipient, obligation)
 
+    def send_obligation_schedule(self, recipient, schedule: ObligationSchedule) -> None:
+        """
+        Register a recurring series of obligations to `recipient`. Each
+        Obligation is sent by the mailbox only when it is about to arrive.
+        """
+        schedule.recipient = recipient
+        self.mailbox.add_obligation_schedule(schedule)
+
     def send_cash(self, recipient, amount) -> None:
         self.send(recipient, amount)
 
@@ -78,6 +235,11 @@ class Agent(Messenger):
         elif contract.get_liability_party() == self:
             # This contract is a liability for me
             self.main_ledger.add_liability(contract)
+        else:
+            return
+        exposures = self.simulation.exposures
+        if exposures is not None:
+            exposures.add_contract(self, contract)
 
     def get_name(self) -> str:
         return self.name
@@ -157,7 +319,33 @@ class Trader(Agent):
         amount_give,
         valuation_give,
     ) -> None:
-        raise NotImplementedError
+        my_ledger = self.get_ledger()
+        partner_ledger = trade_partner.get_ledger()
+        # Check both sides first so that a failed barter books nothing
+        have = my_ledger.inventory.get_good(name_give)
+        if amount_give - have > eps:
+            raise NotEnoughGoods(name_give, have, amount_give)
+        have = partner_ledger.inventory.get_good(name_get)
+        if amount_get - have > eps:
+            raise NotEnoughGoods(name_get, have, amount_get)
+        my_ledger.destroy(name_give, amount_give)
+        partner_ledger.create(name_give, amount_give, valuation_give)
+        partner_ledger.destroy(name_get, amount_get)
+        my_ledger.create(name_get, amount_get, valuation_get)
+
+    def buy(self, market, good_name: str, quantity: float, limit_price: float) -> None:
+        """
+        Submit a buy order to a economicsl.market.CallMarket. It is settled
+        when the market is cleared.
+        """
+        market.submit(self, good_name, quantity, limit_price, True)
+
+    def sell(self, market, good_name: str, quantity: float, limit_price: float) -> None:
+        """
+        Submit a sell order to a economicsl.market.CallMarket. It is settled
+        when the market is cleared.
+        """
+        market.submit(self, good_name, quantity, limit_price, False)
 
     def give(self, recipient: Agent, good_name: str, amount_give: float) -> None:
         valuation = self.get_ledger().get_physical_thing_valuation(good_name)
@@ -166,14 +354,33 @@ class Trader(Agent):
         self.postbox.append((recipient, good_message))
 
 
+class ObligationTotals:
+    __slots__ = "matured", "pending", "pending_to_me"
+
+    def __init__(self) -> None:
+        self.matured = 0.0
+        self.pending = 0.0
+        self.pending_to_me = 0.0
+
+
 class Mailbox:
-    __slots__ = "me", "obligation_unopened", "obligation_outbox", "obligation_inbox"
+    __slots__ = (
+        "me",
+        "obligation_unopened",
+        "obligation_outbox",
+        "obligation_inbox",
+        "obligation_schedules",
+    )
 
     def __init__(self, me) -> None:
         self.me = me
         self.obligation_unopened: List[Any] = []
-        self.obligation_outbox: List[Any] = []
+        # An insertion-ordered dict used as a set, so that ExposureIndex.kill
+        # can purge an obligation in O(1)
+        self.obligation_outbox: Dict[Any, None] = {}
         self.obligation_inbox: List[Any] = []
+        # A heap of (time to send, id, schedule)
+        self.obligation_schedules: List[Any] = []
 
     def receive(self, message: AbstractMessage) -> None:
         if isinstance(message, Obligation):
@@ -199,24 +406,112 @@ class Mailbox:
             self.me.add_cash(message)
 
     def add_to_obligation_outbox(self, obligation) -> None:
-        self.obligation_outbox.append(obligation)
+        self.obligation_outbox[obligation] = None
+
+    def add_obligation_schedule(self, schedule: ObligationSchedule) -> None:
+        if schedule.has_payments():
+            heapq.heappush(
+                self.obligation_schedules,
+                (schedule.get_next_time_to_send(), id(schedule), schedule),
+            )
+
+    def send_scheduled_obligations(self) -> None:
+        """
+        Materialize the obligations of the schedules whose next payment is
+        about to arrive. Only the head of the heap is looked at, so the
+        payments that are far in the future cost nothing.
+        """
+        schedules = self.obligation_schedules
+        time = self.me.get_time()
+        while schedules and schedules[0][0] <= time:
+            _, _, schedule = heapq.heappop(schedules)
+            if not schedule.contract.get_liability_party().alive:
+                # The rest of the schedule is dropped, just like the pending
+                # obligations in the outbox
+                continue
+            self.me.send_obligation(schedule.recipient, schedule.materialize(time))
+            self.add_obligation_schedule(schedule)
+
+    # A raw loop is used instead of sum() over a list in the getters below so
+    # that no temporary list is built
 
     def get_matured_obligations(self) -> float:
-        return sum(
-            [
-                o.get_amount()
-                for o in self.obligation_inbox
-                if o.is_due() and not o.is_fulfilled()
-            ]
-        )
+        out = 0.0
+        for o in self.obligation_inbox:
+            if o.is_due() and not o.fulfilled:
+                out += o.amount
+        return out
 
     def get_all_pending_obligations(self) -> float:
-        return sum(
-            [o.get_amount() for o in self.obligation_inbox if not o.is_fulfilled()]
-        )
+        out = 0.0
+        for o in self.obligation_inbox:
+            if not o.fulfilled:
+                out += o.amount
+        return out
 
     def get_pending_payments_to_me(self) -> float:
-        return sum([o.get_amount() for o in self.obligation_outbox if o.is_fulfilled()])
+        out = 0.0
+        for o in self.obligation_outbox:
+            if o.fulfilled:
+                out += o.amount
+        return out
+
+    def get_obligation_totals(self, out=None) -> "ObligationTotals":
+        """
+        Compute the matured obligations, all pending obligations and the
+        pending payments to me in one pass over the inbox and the outbox.
+        If `out` is given, it is reused for the result.
+        """
+        if out is None:
+            out = ObligationTotals()
+        matured = 0.0
+        pending = 0.0
+        for o in self.obligation_inbox:
+            if not o.fulfilled:
+                pending += o.amount
+                if o.is_due():
+                    matured += o.amount
+        out.matured = matured
+        out.pending = pending
+        out.pending_to_me = self.get_pending_payments_to_me()
+        return out
+
+    def get_pending_obligations_by_counterparty(self, out=None) -> Dict[Any, float]:
+        """
+        Pending obligations grouped by the agent they have to be paid to.
+        If `out` is given, it is cleared and reused for the result.
+        """
+        if out is None:
+            out = {}
+        else:
+            out.clear()
+        for o in self.obligation_inbox:
+            if not o.fulfilled:
+                out[o.to] = out.get(o.to, 0.0) + o.amount
+        return out
+
+    def get_pending_payments_to_me_by_counterparty(self, out=None) -> Dict[Any, float]:
+        """
+        Pending payments to me grouped by the agent that pays them.
+        If `out` is given, it is cleared and reused for the result.
+        """
+        if out is None:
+            out = {}
+        else:
+            out.clear()
+        for o in self.obligation_outbox:
+            if o.fulfilled:
+                out[o.from_] = out.get(o.from_, 0.0) + o.amount
+        return out
+
+    def iter_matured_obligations(self) -> Iterator[Obligation]:
+        return (o for o in self.obligation_inbox if o.is_due() and not o.fulfilled)
+
+    def iter_pending_obligations(self) -> Iterator[Obligation]:
+        return (o for o in self.obligation_inbox if not o.fulfilled)
+
+    def iter_pending_payments_to_me(self) -> Iterator[Obligation]:
+        return (o for o in self.obligation_outbox if o.fulfilled)
 
     def fulfil_all_requests(self) -> None:
         for o in self.obligation_inbox:
@@ -233,12 +528,20 @@ class Mailbox:
         - Remove all fulfilled requests from the inbox and outbox.
         - Remove all pending outgoing requests to institutions who have defaulted in the previous round.
         - Move all messages from unread mailbox to inbox, i.e. "mark as read".
+        - Send the scheduled obligations that are about to arrive.
         """
         self.obligation_inbox = [o for o in self.obligation_inbox if not o.fulfilled]
-        # PERF o.from_.alive is faster than o.get_from().is_alive()
-        self.obligation_outbox = [
-            o for o in self.obligation_outbox if (not o.fulfilled) and o.from_.alive
-        ]
+        if self.me.simulation.exposures is None:
+            # PERF o.from_.alive is faster than o.get_from().is_alive()
+            self.obligation_outbox = {
+                o: None for o in self.obligation_outbox if (not o.fulfilled) and o.from_.alive
+            }
+        else:
+            # ExposureIndex.kill has already purged the obligations of the
+            # dead agents
+            self.obligation_outbox = {
+                o: None for o in self.obligation_outbox if not o.fulfilled
+            }
 
         # Move all messages in the obligation_unopened to the obligation_inbox
         self.obligation_inbox += [
@@ -248,6 +551,17 @@ class Mailbox:
             o for o in self.obligation_unopened if not o.has_arrived()
         ]
 
+        if self.obligation_schedules:
+            self.send_scheduled_obligations()
+
+    def is_empty(self) -> bool:
+        return not (
+            self.obligation_unopened or
+            self.obligation_inbox or
+            self.obligation_outbox or
+            self.obligation_schedules
+        )
+
     def print_mailbox(self) -> None:
         if (
             (not self.obligation_unopened)
@@ -274,7 +588,7 @@ class Mailbox:
             print()
 
     def get_obligation_outbox(self):
-        return self.obligation_outbox
+        return list(self.obligation_outbox)
 
     def get_obligation_inbox(self):
         return self.obligation_inbox
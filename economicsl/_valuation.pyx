@@ -0,0 +1,33 @@
+# cython: boundscheck=False, wraparound=False, initializedcheck=False
+from cython.parallel import prange
+
+
+def valuate(
+    const double[::1] assets,
+    const long long[::1] asset_offsets,
+    const double[::1] liabilities,
+    const long long[::1] liability_offsets,
+    const double[::1] cash,
+    double[:, ::1] out,
+):
+    """
+    Fill out[i] with the asset, liability and equity valuation of agent i.
+    The valuations of agent i's contracts are
+    assets[asset_offsets[i]:asset_offsets[i + 1]] and likewise for the
+    liabilities. The agents are split across OpenMP threads without the GIL;
+    the number of threads is set with OMP_NUM_THREADS.
+    """
+    cdef Py_ssize_t i, j
+    cdef Py_ssize_t n = cash.shape[0]
+    cdef double a, l
+    for i in prange(n, nogil=True, schedule="static"):
+        # Plain assignments (not +=) keep a and l private to each thread
+        a = cash[i]
+        for j in range(asset_offsets[i], asset_offsets[i + 1]):
+            a = a + assets[j]
+        l = 0.0
+        for j in range(liability_offsets[i], liability_offsets[i + 1]):
+            l = l + liabilities[j]
+        out[i, 0] = a
+        out[i, 1] = l
+        out[i, 2] = a - l
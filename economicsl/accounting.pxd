@@ -24,6 +24,10 @@ cdef class FastLedger:
     cpdef double get_asset_valuation_of(self, object contract_type, contract_subtype=*)
     @cython.locals(out=double, c=Contract)
     cpdef double get_liability_valuation_of(self, object contract_type)
+    @cython.locals(total=double, sublist=list, a=Contract)
+    cpdef dict get_asset_valuations_by_type(self, out=*)
+    @cython.locals(total=double, sublist=list, a=Contract)
+    cpdef dict get_liability_valuations_by_type(self, out=*)
     #cpdef object get_all_assets(self)
     #cpdef object get_all_liabilities(self)
     #cpdef object get_assets_of_type(self, object contractType)
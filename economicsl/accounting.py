@@ -1,4 +1,4 @@
-from typing import Any, List, Dict
+from typing import Any, List, Dict, Iterator
 
 from .abce import NotEnoughGoods, Inventory, eps
 from .contract import Contracts
@@ -101,6 +101,48 @@ class FastLedger:
             out += c.get_valuation("L")
         return out
 
+    def get_asset_valuations_by_type(self, out=None) -> Dict[str, float]:
+        """
+        Asset valuation of every contract type, computed in one pass.
+        If `out` is given, it is cleared and reused for the result.
+        """
+        if out is None:
+            out = {}
+        else:
+            out.clear()
+        for ctype, sublist in self.contracts.all_assets.items():
+            total = 0.0
+            for a in sublist:
+                total += a.get_valuation("A")
+            out[ctype] = total
+        return out
+
+    def get_liability_valuations_by_type(self, out=None) -> Dict[str, float]:
+        """
+        Liability valuation of every contract type, computed in one pass.
+        If `out` is given, it is cleared and reused for the result.
+        """
+        if out is None:
+            out = {}
+        else:
+            out.clear()
+        for ctype, sublist in self.contracts.all_liabilities.items():
+            total = 0.0
+            for a in sublist:
+                total += a.get_valuation("L")
+            out[ctype] = total
+        return out
+
+    def iter_assets(self) -> Iterator[Any]:
+        # A view version of get_all_assets() that doesn't build a list
+        for sublist in self.contracts.all_assets.values():
+            yield from sublist
+
+    def iter_liabilities(self) -> Iterator[Any]:
+        # A view version of get_all_liabilities() that doesn't build a list
+        for sublist in self.contracts.all_liabilities.values():
+            yield from sublist
+
     def get_all_assets(self) -> List[Any]:
         return [
             asset for sublist in self.contracts.all_assets.values() for asset in sublist
@@ -171,7 +213,13 @@ class FastLedger:
 # A simple economic agent will usually have a single Ledger, whereas complex firms and banks can have several books
 # (as in branch banking for example).
 class Ledger(FastLedger):
-    __slots__ = "asset_accounts", "inventory", "goods_accounts", "liability_accounts"
+    __slots__ = (
+        "asset_accounts",
+        "inventory",
+        "goods_accounts",
+        "liability_accounts",
+        "goods_index",
+    )
 
     def __init__(self) -> None:
         # A Ledger is a list of accounts (for quicker searching)
@@ -189,6 +237,8 @@ class Ledger(FastLedger):
         self.goods_accounts: Dict[str, Any] = {}
         # a hashmap from a contract type string to a liability_account
         self.liability_accounts: Dict[str, Any] = {}
+        # See economicsl.population.GoodsIndex
+        self.goods_index = None
 
     def get_asset_valuation(self) -> float:
         return (
@@ -200,6 +250,9 @@ class Ledger(FastLedger):
             + self.inventory.get_cash()
         )
 
+    def new_account(self, name: str, account_type: int) -> Account:
+        return Account(name, account_type)
+
     def add_account(self, account, contract: Contract) -> None:
         switch = account.account_type
         if switch == AccountType.ASSET:
@@ -217,7 +270,7 @@ class Ledger(FastLedger):
 
         if asset_account is None:
             # If there doesn't exist an Account to hold this type of contract, we create it
-            asset_account = Account(contract.get_name(), AccountType.ASSET)
+            asset_account = self.new_account(contract.get_name(), AccountType.ASSET)
             self.add_account(asset_account, contract)
 
         asset_account.debit(contract.get_valuation("A"))
@@ -232,7 +285,7 @@ class Ledger(FastLedger):
 
         if liability_account is None:
             # If there doesn't exist an Account to hold this type of contract, we create it
-            liability_account = Account(contract.get_name(), AccountType.LIABILITY)
+            liability_account = self.new_account(contract.get_name(), AccountType.LIABILITY)
             self.add_account(liability_account, contract)
 
         liability_account.credit(contract.get_valuation("L"))
@@ -243,6 +296,8 @@ class Ledger(FastLedger):
     def create(self, name: str, amount, valuation) -> None:
         self.inventory.create(name, amount)
         self.get_goods_account(name).debit(amount * valuation)
+        if self.goods_index is not None:
+            self.goods_index.set_quantity(self, name, self.inventory.get_good(name))
 
     def destroy(self, name: str, amount, valuation=None) -> None:
         if valuation is None:
@@ -254,12 +309,16 @@ class Ledger(FastLedger):
         else:
             self.inventory.destroy(name, amount)
             self.get_goods_account(name).credit(amount * valuation)
+            if self.goods_index is not None:
+                self.goods_index.set_quantity(self, name, self.inventory.get_good(name))
 
     def get_goods_account(self, name: str) -> Account:
         account = self.goods_accounts.get(name)
         if account is None:
-            account = Account(name, AccountType.GOOD)
+            account = self.new_account(name, AccountType.GOOD)
             self.goods_accounts[name] = account
+            if self.goods_index is not None:
+                self.goods_index.add_holder(self, name, account)
         return account
 
     def get_physical_thing_valuation(self, name: str) -> float:
@@ -329,14 +388,14 @@ class Ledger(FastLedger):
             print(a.get_name(), "-> %.2f" % a.balance)
 
         print("Breakdown: ")
-        for c in self.get_all_assets():
+        for c in self.iter_assets():
             print("\t", c.get_name(me), " > ", c.get_valuation("A"))
         print("TOTAL ASSETS: %.2f" % self.get_asset_valuation())
 
         print("\nLiability accounts:\n---------------")
         for a in self.liability_accounts.values():
             print(a.get_name(), " -> %.2f" % a.balance)
-        for c in self.get_all_liabilities():
+        for c in self.iter_liabilities():
             print("\t", c.get_name(me), " > ", c.get_valuation("L"))
         print("TOTAL LIABILITIES: %.2f" % self.get_liability_valuation())
         print("\nTOTAL EQUITY: %.2f" % self.get_equity_valuation())
@@ -370,7 +429,8 @@ class Ledger(FastLedger):
             raise Exception("Asset account not found for ${asset.ctype}.")
         account.credit(valuationLost)
 
-        # TODO: perform a check here that the Asset account balances match the valuation of the assets. (?)
+        # The check that the Asset account balances match the valuation of the
+        # assets is done incrementally by ReconciledLedger.reconcile().
 
     def appreciate_asset(self, asset, valuationLost: float) -> None:
         account = self.asset_accounts.get(asset.ctype)
@@ -0,0 +1,141 @@
+import hashlib
+import os
+import pickle
+import tempfile
+from typing import Any, Callable, Dict
+
+import numpy as np
+
+from . import __version__
+
+_MISSING = object()
+
+
+def _sized(tag: bytes, data: bytes) -> bytes:
+    # The length prefix keeps the encoding of a container unambiguous
+    return tag + b"%d:" % len(data) + data
+
+
+def canonicalize(obj) -> bytes:
+    """
+    Encode a parameter as bytes that only depend on its value and type, e.g.
+    {1: 2} and {"1": 2} differ, and so do arrays that only differ in the
+    elements a repr would elide. Raises a TypeError for the types that have
+    no canonical encoding.
+    """
+    if obj is None:
+        return b"N"
+    if isinstance(obj, (bool, np.bool_)):
+        return b"B1" if obj else b"B0"
+    if isinstance(obj, (int, np.integer)):
+        return _sized(b"I", b"%d" % obj)
+    if isinstance(obj, (float, np.floating)):
+        return _sized(b"F", float(obj).hex().encode())
+    if isinstance(obj, str):
+        return _sized(b"S", obj.encode())
+    if isinstance(obj, bytes):
+        return _sized(b"Y", obj)
+    if isinstance(obj, tuple):
+        return _sized(b"T", b"".join(canonicalize(x) for x in obj))
+    if isinstance(obj, list):
+        return _sized(b"L", b"".join(canonicalize(x) for x in obj))
+    if isinstance(obj, (set, frozenset)):
+        return _sized(b"E", b"".join(sorted(canonicalize(x) for x in obj)))
+    if isinstance(obj, dict):
+        items = sorted(canonicalize(k) + canonicalize(v) for k, v in obj.items())
+        return _sized(b"D", b"".join(items))
+    if isinstance(obj, np.ndarray):
+        if obj.dtype.hasobject:
+            raise TypeError("Can't hash an array of dtype object")
+        header = canonicalize((obj.dtype.str, obj.shape))
+        return _sized(b"A", header + np.ascontiguousarray(obj).tobytes())
+    raise TypeError("Can't hash a parameter of type %s" % type(obj).__name__)
+
+
+class ResultCache:
+    """
+    An on-disk cache of the outputs of simulation runs, keyed by a hash of
+    the parameters, the random seed and the economicsl version.
+    The least recently used entries are evicted when the total size of the
+    cache directory exceeds `max_bytes`.
+    """
+
+    __slots__ = "directory", "max_bytes"
+
+    def __init__(self, directory: str, max_bytes: int = 1 << 30) -> None:
+        self.directory = directory
+        self.max_bytes = max_bytes
+        os.makedirs(directory, exist_ok=True)
+
+    def get_key(self, params: Dict[str, Any], seed) -> str:
+        payload = canonicalize((params, seed, __version__))
+        return hashlib.sha256(payload).hexdigest()
+
+    def get_path(self, key: str) -> str:
+        return os.path.join(self.directory, key + ".pkl")
+
+    def get(self, key: str, default=None) -> Any:
+        path = self.get_path(key)
+        try:
+            with open(path, "rb") as f:
+                value = pickle.load(f)
+            # Mark as recently used
+            os.utime(path)
+        except FileNotFoundError:
+            # Missing, or evicted since it was read
+            return default
+        except (pickle.UnpicklingError, EOFError, AttributeError, ImportError):
+            # A corrupt entry, or one whose classes are gone, is a miss
+            self.remove(path)
+            return default
+        return value
+
+    def remove(self, path: str) -> None:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+    def put(self, key: str, value) -> None:
+        # Write to a temporary file first so that a crash never leaves a
+        # truncated entry behind
+        fd, tmp = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                pickle.dump(value, f, pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp, self.get_path(key))
+        except BaseException:
+            # evict() only sees the .pkl entries, so nothing else would
+            # remove the temporary file
+            self.remove(tmp)
+            raise
+        self.evict()
+
+    def evict(self) -> None:
+        entries = []
+        total = 0
+        with os.scandir(self.directory) as it:
+            for entry in it:
+                if entry.name.endswith(".pkl"):
+                    stat = entry.stat()
+                    entries.append((stat.st_mtime, stat.st_size, entry.path))
+                    total += stat.st_size
+        entries.sort()
+        for _, size, path in entries:
+            if total <= self.max_bytes:
+                break
+            os.remove(path)
+            total -= size
+
+    def run(self, simulate: Callable[[Dict[str, Any], Any], Any], params: Dict[str, Any], seed) -> Any:
+        """
+        Return the cached output of `simulate(params, seed)`, running it only
+        on a cache miss.
+        """
+        key = self.get_key(params, seed)
+        result = self.get(key, _MISSING)
+        if result is not _MISSING:
+            return result
+        result = simulate(params, seed)
+        self.put(key, result)
+        return result
@@ -0,0 +1,73 @@
+from collections import defaultdict
+from typing import Any, Callable, Dict, List, Optional
+
+
+class ExposureIndex:
+    """
+    A simulation-wide reverse index from each agent to the contracts and the
+    obligations it is party to, so that a default can be propagated in
+    O(degree) instead of scanning every ledger and mailbox.
+    The contracts and obligations of an agent are kept in insertion-ordered
+    dicts used as sets, so that they can be removed in O(1).
+    """
+
+    __slots__ = "contracts", "obligations", "_compacted_size"
+
+    def __init__(self) -> None:
+        self.contracts: Dict[Any, Dict[Any, None]] = defaultdict(dict)
+        self.obligations: Dict[Any, Dict[Any, None]] = defaultdict(dict)
+        # The size of each obligation set after it was last compacted
+        self._compacted_size: Dict[Any, int] = {}
+
+    def add_contract(self, agent, contract) -> None:
+        self.contracts[agent][contract] = None
+
+    def add_obligation(self, obligation) -> None:
+        for agent in (obligation.from_, obligation.to):
+            obligations = self.obligations[agent]
+            obligations[obligation] = None
+            # Drop the fulfilled obligations every time the set has doubled,
+            # which keeps the index bounded at amortized O(1) cost
+            if len(obligations) > 2 * self._compacted_size.get(agent, 8):
+                self.obligations[agent] = {o: None for o in obligations if not o.fulfilled}
+                self._compacted_size[agent] = len(self.obligations[agent])
+
+    def get_contracts_of(self, agent) -> List[Any]:
+        return list(self.contracts.get(agent, ()))
+
+    def get_obligations_of(self, agent) -> List[Any]:
+        return [o for o in self.obligations.get(agent, ()) if not o.fulfilled]
+
+    def kill(self, agent, write_down: Optional[Callable[[Any, Any], None]] = None) -> None:
+        """
+        Mark `agent` as dead, purge the pending obligations it has to pay
+        from its creditors' outboxes, drop its contracts and obligations from
+        its counterparties' entries and, if given, call
+        `write_down(contract, counterparty)` for each of its contracts with a
+        living counterparty.
+        """
+        agent.alive = False
+        self._compacted_size.pop(agent, None)
+        for o in self.obligations.pop(agent, ()):
+            if o.fulfilled:
+                # Already paid, only waiting to be received
+                continue
+            if o.from_ is agent:
+                counterparty = o.to
+                counterparty.mailbox.obligation_outbox.pop(o, None)
+            else:
+                counterparty = o.from_
+            others = self.obligations.get(counterparty)
+            if others is not None:
+                others.pop(o, None)
+
+        for contract in self.contracts.pop(agent, ()):
+            if contract.get_asset_party() is agent:
+                counterparty = contract.get_liability_party()
+            else:
+                counterparty = contract.get_asset_party()
+            others = self.contracts.get(counterparty)
+            if others is not None:
+                others.pop(contract, None)
+            if write_down is not None and counterparty.alive:
+                write_down(contract, counterparty)
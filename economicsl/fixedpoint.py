@@ -0,0 +1,151 @@
+from typing import Dict, Iterator
+
+from .abce import NotEnoughGoods
+from .accounting import Account, FastLedger, Ledger
+
+# Number of minor units in one unit of money or of a good, e.g. cents
+SCALE = 100
+
+
+def to_minor(amount, scale: int = SCALE) -> int:
+    # round() rounds half to even, i.e. this is banker's rounding
+    return int(round(amount * scale))
+
+
+class FixedAccount(Account):
+    """
+    An Account whose balance is kept as an integer number of minor units.
+    Amounts are rounded only once, when they are debited or credited, and
+    `balance` mirrors `units` for the code that reads it.
+    """
+
+    __slots__ = "units", "scale"
+
+    def __init__(
+        self, name: str, account_type: int, starting_balance: float = 0.0, scale: int = SCALE
+    ) -> None:
+        super().__init__(name, account_type)
+        self.scale = scale
+        self.units = to_minor(starting_balance, scale)
+        self.balance = self.units / scale
+
+    def debit(self, amount):
+        """
+        A Debit is a positive change for ASSET and EXPENSES accounts, and negative for the rest.
+        """
+        if self._is_asset_or_expenses:
+            self.units += to_minor(amount, self.scale)
+        else:
+            self.units -= to_minor(amount, self.scale)
+        self.balance = self.units / self.scale
+
+    def credit(self, amount):
+        """
+        A Credit is a negative change for ASSET and EXPENSES accounts, and positive for the rest.
+        """
+        if self._is_asset_or_expenses:
+            self.units -= to_minor(amount, self.scale)
+        else:
+            self.units += to_minor(amount, self.scale)
+        self.balance = self.units / self.scale
+
+
+class FixedInventory:
+    """
+    An Inventory whose quantities are stored as integer numbers of minor
+    units, so that destroy() needs no epsilon tolerance.
+    """
+
+    __slots__ = "units", "scale"
+
+    def __init__(self, scale: int = SCALE) -> None:
+        self.units: Dict[str, int] = {}
+        self.scale = scale
+
+    def get_good(self, name: str) -> float:
+        return self.units.get(name, 0) / self.scale
+
+    def get(self, name: str, default=0.0) -> float:
+        if name not in self.units:
+            return default
+        return self.units[name] / self.scale
+
+    def __contains__(self, name: str) -> bool:
+        return name in self.units
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self.units)
+
+    @property
+    def cash(self) -> float:
+        return self.get_good("cash")
+
+    def get_cash(self) -> float:
+        return self.get_good("cash")
+
+    def create(self, name: str, amount) -> None:
+        assert amount >= 0.0, amount
+        self.units[name] = self.units.get(name, 0) + to_minor(amount, self.scale)
+
+    def destroy(self, name: str, amount) -> None:
+        assert amount >= 0.0, amount
+        have = self.units.get(name, 0)
+        required = to_minor(amount, self.scale)
+        if required > have:
+            raise NotEnoughGoods(name, have / self.scale, amount)
+        self.units[name] = have - required
+
+
+class FixedFastLedger(FastLedger):
+    """
+    A FastLedger, the default ledger of an Agent, whose cash is kept as an
+    integer number of minor units. `cash` mirrors `units` for the code that
+    reads it, e.g. Agent.get_cash. Use it with
+    `agent.main_ledger = FixedFastLedger()`.
+    """
+
+    __slots__ = "units", "scale"
+
+    def __init__(self, scale: int = SCALE) -> None:
+        super().__init__()
+        self.scale = scale
+        self.units = 0
+
+    def add_cash(self, amount: float) -> None:
+        self.units += to_minor(amount, self.scale)
+        self.cash = self.units / self.scale
+
+    def subtract_cash(self, amount: float) -> None:
+        self.units -= to_minor(amount, self.scale)
+        self.cash = self.units / self.scale
+
+
+class FixedLedger(Ledger):
+    """
+    A Ledger that stores money and quantities of goods as integer minor
+    units (1 / `scale` of a unit). Amounts are rounded with banker's rounding
+    when they enter the ledger; from there on all the accounting is exact
+    and reproducible.
+    """
+
+    __slots__ = ("scale",)
+
+    def __init__(self, scale: int = SCALE) -> None:
+        super().__init__()
+        self.scale = scale
+        self.inventory = FixedInventory(scale)
+
+    def new_account(self, name: str, account_type: int) -> FixedAccount:
+        return FixedAccount(name, account_type, scale=self.scale)
+
+    def pay_liability(self, amount, loan) -> None:
+        liability_account = self.liability_accounts.get(loan.ctype)
+        if not liability_account:
+            raise Exception("Liability account for ${loan} doesn't exist")
+
+        # Pre-condition: liquidity has been raised.
+        available = self.inventory.units.get("cash", 0)
+        assert available >= to_minor(amount, self.scale), (available / self.scale, amount)
+
+        # (dr liability, cr cash )
+        self.book(liability_account, self.get_goods_account("cash"), amount)
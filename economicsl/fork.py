@@ -0,0 +1,39 @@
+import multiprocessing
+from typing import Any, Callable, Iterable, List, Optional
+
+# The state shared with the forked workers. It is inherited through fork()
+# rather than pickled, so the workers see it as copy-on-write memory.
+_state: Any = None
+_scenario: Optional[Callable[[Any, Any], Any]] = None
+
+
+def _run_branch(branch) -> Any:
+    return _scenario(_state, branch)
+
+
+def run_counterfactuals(
+    scenario: Callable[[Any, Any], Any],
+    state: Any,
+    branches: Iterable[Any],
+    processes: Optional[int] = None,
+) -> List[Any]:
+    """
+    Evaluate `scenario(state, branch)` for every branch, each one on its own
+    copy of `state` (typically the Simulation together with its agents).
+    Every branch runs in a freshly forked worker process, so the copy is
+    made lazily by the OS: only the memory pages of the objects a branch
+    actually modifies are duplicated, and the base state is never pickled.
+    Only the return values of `scenario` have to be picklable.
+    This requires the "fork" start method, i.e. it is not available on
+    Windows.
+    """
+    global _state, _scenario
+    ctx = multiprocessing.get_context("fork")
+    _state, _scenario = state, scenario
+    try:
+        # maxtasksperchild=1 so that no branch sees the changes made by
+        # another branch
+        with ctx.Pool(processes, maxtasksperchild=1) as pool:
+            return pool.map(_run_branch, branches, chunksize=1)
+    finally:
+        _state, _scenario = None, None
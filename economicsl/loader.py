@@ -0,0 +1,144 @@
+import os
+from typing import Any, Callable, Dict, List, Sequence
+
+import numpy as np
+
+from .accounting import AccountType, FastLedger, Ledger
+
+
+def _load(directory: str, name: str, mmap_mode):
+    path = os.path.join(directory, name + ".npy")
+    if not os.path.exists(path):
+        return None
+    return np.load(path, mmap_mode=mmap_mode)
+
+
+def _runs(keys):
+    """
+    The boundaries of the runs of equal keys in a sorted array.
+    """
+    if len(keys) == 0:
+        return np.zeros(1, dtype=np.int64)
+    starts = np.flatnonzero(keys[1:] != keys[:-1]) + 1
+    return np.concatenate(([0], starts, [len(keys)]))
+
+
+def _has_bulk_add(ledger, method: str) -> bool:
+    # Subclasses that override add_asset/add_liability, e.g. ReconciledLedger,
+    # must see every contract
+    return getattr(type(ledger), method) in (
+        getattr(FastLedger, method),
+        getattr(Ledger, method),
+    )
+
+
+def _add_contracts(agents, side: str, parties, ctypes, contracts, ctype_names) -> None:
+    if side == "A":
+        method, account_type = "add_asset", AccountType.ASSET
+    else:
+        method, account_type = "add_liability", AccountType.LIABILITY
+    order = np.lexsort((ctypes, parties))
+    sorted_parties = parties[order]
+    sorted_ctypes = ctypes[order]
+    # A run is a block of contracts with the same party and contract type
+    bounds = _runs(sorted_parties * len(ctype_names) + sorted_ctypes)
+    order = order.tolist()
+    for i in range(len(bounds) - 1):
+        start, end = bounds[i], bounds[i + 1]
+        ledger = agents[sorted_parties[start]].get_ledger()
+        run = [contracts[j] for j in order[start:end]]
+        if not _has_bulk_add(ledger, method):
+            add = getattr(ledger, method)
+            for contract in run:
+                add(contract)
+            continue
+        ctype = run[0].ctype
+        if side == "A":
+            ledger.contracts.all_assets[ctype].extend(run)
+        else:
+            ledger.contracts.all_liabilities[ctype].extend(run)
+        if isinstance(ledger, Ledger):
+            accounts = ledger.asset_accounts if side == "A" else ledger.liability_accounts
+            account = accounts.get(ctype)
+            if account is None:
+                account = ledger.new_account(run[0].get_name(), account_type)
+                ledger.add_account(account, run[0])
+            # The contracts may value themselves differently on each side
+            total = 0.0
+            for contract in run:
+                total += contract.get_valuation(side)
+            if side == "A":
+                account.debit(total)
+            else:
+                account.credit(total)
+
+
+def load_balance_sheets(
+    agents: Sequence[Any],
+    directory: str,
+    contract_factories: Dict[str, Callable[[Any, Any, float], Any]],
+    mmap_mode="r",
+) -> List[Any]:
+    """
+    Populate the ledgers of `agents` from the columnar .npy files in
+    `directory`. Agents are referred to by their position in `agents`, and
+    contract types and goods by their position in ctypes.npy and goods.npy.
+    All files are optional:
+
+    - cash.npy: the cash of each agent
+    - contract_asset_party.npy, contract_liability_party.npy,
+      contract_ctype.npy, contract_valuation.npy: one row per contract;
+      `contract_factories[ctype](asset_party, liability_party, valuation)`
+      creates the contract
+    - inventory_agent.npy, inventory_good.npy, inventory_amount.npy,
+      inventory_valuation.npy: one row per stock of a good
+
+    The contracts are added to their parties' ledgers in bulk, with a single
+    booking per agent and contract type whose amount is the sum of the
+    valuations of its contracts on that side. Returns the contracts that
+    were created.
+    """
+    cash = _load(directory, "cash", mmap_mode)
+    if cash is not None:
+        for agent, amount in zip(agents, cash.tolist()):
+            if amount:
+                agent.add_cash(amount)
+
+    contracts: List[Any] = []
+    asset_parties = _load(directory, "contract_asset_party", mmap_mode)
+    if asset_parties is not None:
+        liability_parties = _load(directory, "contract_liability_party", mmap_mode)
+        ctypes = _load(directory, "contract_ctype", mmap_mode)
+        valuations = _load(directory, "contract_valuation", mmap_mode)
+        ctype_names = _load(directory, "ctypes", None).tolist()
+        factories = [contract_factories[name] for name in ctype_names]
+        contracts = [
+            factories[c](agents[a], agents[b], v)
+            for a, b, c, v in zip(
+                asset_parties.tolist(),
+                liability_parties.tolist(),
+                ctypes.tolist(),
+                valuations.tolist(),
+            )
+        ]
+        _add_contracts(agents, "A", asset_parties, ctypes, contracts, ctype_names)
+        _add_contracts(agents, "L", liability_parties, ctypes, contracts, ctype_names)
+
+        exposures = agents[0].get_simulation().exposures if len(agents) else None
+        if exposures is not None:
+            for contract in contracts:
+                exposures.add_contract(contract.get_asset_party(), contract)
+                exposures.add_contract(contract.get_liability_party(), contract)
+
+    holders = _load(directory, "inventory_agent", mmap_mode)
+    if holders is not None:
+        goods = _load(directory, "goods", None).tolist()
+        for a, g, amount, valuation in zip(
+            holders.tolist(),
+            _load(directory, "inventory_good", mmap_mode).tolist(),
+            _load(directory, "inventory_amount", mmap_mode).tolist(),
+            _load(directory, "inventory_valuation", mmap_mode).tolist(),
+        ):
+            agents[a].get_ledger().create(goods[g], amount, valuation)
+
+    return contracts
@@ -0,0 +1,195 @@
+from collections import defaultdict
+from typing import Any, Dict, List, Optional, Set, Tuple
+
+import numpy as np
+
+from .abce import NotEnoughGoods, eps
+
+
+def clear_call_auction(quantities, limit_prices, is_buy) -> Tuple[Optional[float], Any]:
+    """
+    Find the uniform price of a call auction and the fill of every order.
+    The price maximizes the executed volume, then minimizes the imbalance
+    between demand and supply; ties are broken by taking the midpoint of
+    the tied prices. The long side of the market is filled pro rata.
+    Returns (price, fills), with price None if nothing can be executed.
+    """
+    quantities = np.asarray(quantities, dtype=float)
+    limit_prices = np.asarray(limit_prices, dtype=float)
+    is_buy = np.asarray(is_buy, dtype=bool)
+    fills = np.zeros(len(quantities))
+
+    buy_prices = limit_prices[is_buy]
+    sell_prices = limit_prices[~is_buy]
+    if len(buy_prices) == 0 or len(sell_prices) == 0:
+        return None, fills
+    order = np.argsort(buy_prices)
+    buy_prices = buy_prices[order]
+    # demand_at[i] is the demand at buy_prices[i], i.e. of buyers willing to
+    # pay at least that much
+    demand_at = np.append(np.cumsum(quantities[is_buy][order][::-1])[::-1], 0.0)
+    order = np.argsort(sell_prices)
+    sell_prices = sell_prices[order]
+    supply_at = np.insert(np.cumsum(quantities[~is_buy][order]), 0, 0.0)
+
+    candidates = np.unique(limit_prices)
+    demand = demand_at[np.searchsorted(buy_prices, candidates, "left")]
+    supply = supply_at[np.searchsorted(sell_prices, candidates, "right")]
+    volume = np.minimum(demand, supply)
+    best = volume.max()
+    if best <= 0:
+        return None, fills
+    imbalance = np.abs(demand - supply)
+    tied = volume == best
+    tied &= imbalance == imbalance[tied].min()
+    price = 0.5 * (candidates[tied].min() + candidates[tied].max())
+
+    buyers = is_buy & (limit_prices >= price)
+    sellers = ~is_buy & (limit_prices <= price)
+    fills[buyers] = quantities[buyers] * (best / quantities[buyers].sum())
+    fills[sellers] = quantities[sellers] * (best / quantities[sellers].sum())
+    return float(price), fills
+
+
+class CallMarket:
+    """
+    Collects the buy and sell orders of Traders during a tick and clears them
+    all at once with one call auction per good. The fills are settled with
+    bulk Ledger bookings: one inventory and one cash booking per agent and
+    good, instead of a GoodMessage per transfer.
+    A sell order is checked against the seller's inventory net of its other
+    sell orders of the good, and a buy order against the buyer's cash net of
+    the limit cost of its other buy orders. If an agent can no longer settle
+    its positions when the market is cleared, e.g. because it spent its cash
+    in the meantime, all its orders are rejected and only the goods it
+    traded are cleared again without them. Every position is checked before
+    the first booking.
+    """
+
+    __slots__ = "orders", "prices", "selling", "spending", "rejected"
+
+    def __init__(self) -> None:
+        # a hashmap from a good name to a list of (agent, quantity, limit price, is buy)
+        self.orders: Dict[str, List[Tuple[Any, float, float, bool]]] = defaultdict(list)
+        # The last clearing price of each good
+        self.prices: Dict[str, float] = {}
+        # The quantity each agent has on sale per good, and the most each
+        # agent can have to pay for its buy orders
+        self.selling: Dict[Tuple[Any, str], float] = defaultdict(float)
+        self.spending: Dict[Any, float] = defaultdict(float)
+        # The agents whose orders were rejected by the last clear()
+        self.rejected: Set[Any] = set()
+
+    def submit(self, agent, good_name: str, quantity: float, limit_price: float, is_buy: bool) -> None:
+        assert quantity >= 0.0, quantity
+        inventory = agent.get_ledger().inventory
+        if is_buy:
+            available = inventory.get_good("cash") - self.spending[agent]
+            cost = quantity * limit_price
+            if cost - available > eps:
+                raise NotEnoughGoods("cash", available, cost)
+            self.spending[agent] += cost
+        else:
+            available = inventory.get_good(good_name) - self.selling[agent, good_name]
+            if quantity - available > eps:
+                raise NotEnoughGoods(good_name, available, quantity)
+            self.selling[agent, good_name] += quantity
+        self.orders[good_name].append((agent, float(quantity), float(limit_price), is_buy))
+
+    def clear(self) -> Dict[str, float]:
+        """
+        Clear and settle the orders of every good, and return the clearing
+        prices of the goods that were traded. The order book is emptied
+        whatever the outcome; the agents whose orders had to be rejected are
+        left in `self.rejected`.
+        """
+        orders = dict(self.orders)
+        goods_of: Dict[Any, Set[str]] = defaultdict(set)
+        for good_name, good_orders in orders.items():
+            for order in good_orders:
+                goods_of[order[0]].add(good_name)
+        rejected: Set[Any] = set()
+        # a hashmap from a good name to its (price, positions)
+        cleared: Dict[str, Tuple[float, List[Tuple[Any, str, float, float]]]] = {}
+        try:
+            stale = set(orders)
+            while True:
+                for good_name in stale:
+                    cleared.pop(good_name, None)
+                    live = [o for o in orders[good_name] if o[0] not in rejected]
+                    if not live:
+                        continue
+                    agents, quantities, limit_prices, is_buy = zip(*live)
+                    price, fills = clear_call_auction(quantities, limit_prices, is_buy)
+                    if price is not None:
+                        deltas = np.where(is_buy, fills, -fills)
+                        cleared[good_name] = (price, self.net(good_name, price, agents, deltas))
+                positions = [p for _, good_positions in cleared.values() for p in good_positions]
+                failing = self.get_failing(positions)
+                if not failing:
+                    break
+                # Each round rejects at least one agent, so this terminates
+                rejected |= failing
+                stale = set()
+                for agent in failing:
+                    stale |= goods_of[agent]
+            self.settle(positions)
+        finally:
+            self.orders.clear()
+            self.selling.clear()
+            self.spending.clear()
+        self.rejected = rejected
+        prices = {good_name: price for good_name, (price, _) in cleared.items()}
+        self.prices.update(prices)
+        return prices
+
+    def net(self, good_name: str, price: float, agents, deltas) -> List[Tuple[Any, str, float, float]]:
+        """
+        Net the fills of the agents that have several orders of a good into
+        (agent, good name, quantity bought, price) positions; a negative
+        quantity is sold.
+        """
+        index: Dict[Any, int] = {}
+        positions = [index.setdefault(a, len(index)) for a in agents]
+        net = np.bincount(positions, weights=deltas, minlength=len(index))
+        return [
+            (agent, good_name, amount, price)
+            for agent, amount in zip(index, net.tolist())
+            if amount != 0.0
+        ]
+
+    def get_failing(self, positions: List[Tuple[Any, str, float, float]]) -> Set[Any]:
+        """
+        The agents that don't hold enough of a good they sold, or enough cash
+        for their net purchases.
+        """
+        failing = set()
+        cash: Dict[Any, float] = defaultdict(float)
+        for agent, good_name, amount, price in positions:
+            cash[agent] -= amount * price
+            if amount < 0.0:
+                have = agent.get_ledger().inventory.get_good(good_name)
+                if -amount - have > eps:
+                    failing.add(agent)
+        for agent, change in cash.items():
+            have = agent.get_ledger().inventory.get_good("cash")
+            if -change - have > eps:
+                failing.add(agent)
+        return failing
+
+    def settle(self, positions: List[Tuple[Any, str, float, float]]) -> None:
+        """
+        Book the positions, which get_failing() has found to be settleable.
+        """
+        # The sales are booked first, so that an agent can pay for its
+        # purchases with the proceeds
+        for agent, good_name, amount, price in positions:
+            if amount < 0.0:
+                ledger = agent.get_ledger()
+                ledger.destroy(good_name, -amount)
+                ledger.add_cash(-amount * price)
+        for agent, good_name, amount, price in positions:
+            if amount > 0.0:
+                ledger = agent.get_ledger()
+                ledger.subtract_cash(amount * price)
+                ledger.create(good_name, amount, price)
@@ -1,3 +1,4 @@
+from collections import deque
 from typing import TYPE_CHECKING
 
 if TYPE_CHECKING:
@@ -101,3 +102,39 @@ class Obligation(AbstractMessage):
             " to arrive by timestep ",
             self.get_time_to_receive(),
         )
+
+
+class ObligationSchedule:
+    """
+    A recurring series of payments on a contract, e.g. the coupons of a bond.
+    The schedule is declared once and each Obligation is only created by the
+    sender's Mailbox `notice` timesteps before it has to be paid.
+    An Obligation sent at tick t is delivered at the end of t and moved to
+    the inbox by Mailbox.step at t + 1, i.e. after the model phases of that
+    tick, so `notice` must be at least 2 for the model to see it mature.
+    """
+
+    __slots__ = "contract", "payments", "notice", "recipient"
+
+    def __init__(self, contract, amounts, ticks, notice: int = 2) -> None:
+        assert notice >= 2, notice
+        self.contract = contract
+        # (time_to_pay, amount) pairs, ordered by time_to_pay
+        self.payments = deque(sorted(zip(ticks, amounts)))
+        self.notice = notice
+        self.recipient = None
+
+    def has_payments(self) -> bool:
+        return len(self.payments) > 0
+
+    def get_next_time_to_send(self) -> int:
+        return self.payments[0][0] - self.notice
+
+    def materialize(self, time: int) -> Obligation:
+        """
+        Create the Obligation for the next payment of the schedule. A payment
+        that is due sooner than it can be seen, e.g. because the schedule was
+        registered late, is postponed to the earliest tick it can mature.
+        """
+        time_to_pay, amount = self.payments.popleft()
+        return Obligation(self.contract, amount, max(time_to_pay - time, 2))
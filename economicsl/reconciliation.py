@@ -0,0 +1,239 @@
+import random
+from typing import Any, Dict, List, Optional, Tuple
+
+from .abce import eps
+from .accounting import Account, AccountType, Ledger
+
+# Keys of the accounts tracked by a ReconciledLedger
+ASSET = "A"
+LIABILITY = "L"
+GOOD = "G"
+
+
+def describe(booking: Tuple[Any, ...]) -> str:
+    """
+    Format a (method, *args) booking as a call.
+    """
+    return "%s(%s)" % (booking[0], ", ".join(str(a) for a in booking[1:]))
+
+
+class Mismatch:
+    __slots__ = "kind", "key", "expected", "actual", "booking"
+
+    def __init__(self, kind: str, key: str, expected: float, actual: float, booking: str) -> None:
+        self.kind = kind
+        self.key = key
+        self.expected = expected
+        self.actual = actual
+        # The last booking that touched the account before the check
+        self.booking = booking
+
+    def get_difference(self) -> float:
+        return self.actual - self.expected
+
+    def __repr__(self) -> str:
+        return "Mismatch(%s %s: expected %f, actual %f, after %s)" % (
+            self.kind,
+            self.key,
+            self.expected,
+            self.actual,
+            self.booking,
+        )
+
+
+class ReconciledLedger(Ledger):
+    """
+    A Ledger that keeps track of which accounts have been booked since the
+    last check, so that reconcile() only has to re-verify those accounts
+    against the valuation of their contracts and the inventory.
+    (PERF) A booking only records a flat (method, *args) tuple, which is
+    formatted only when a mismatch is reported. The Ledger methods are
+    called directly rather than through super() to keep the overhead low
+    enough to leave the checks on.
+    """
+
+    __slots__ = (
+        "dirty_assets",
+        "dirty_liabilities",
+        "dirty_goods",
+        "sample_rate",
+        "rng",
+        "account_keys",
+        "booking",
+    )
+
+    def __init__(self, sample_rate: float = 1.0, seed=None) -> None:
+        Ledger.__init__(self)
+        # hashmaps from a contract type / good name to the last booking
+        self.dirty_assets: Dict[str, Tuple[Any, ...]] = {}
+        self.dirty_liabilities: Dict[str, Tuple[Any, ...]] = {}
+        self.dirty_goods: Dict[str, Tuple[Any, ...]] = {}
+        self.sample_rate = sample_rate
+        self.rng = random.Random(seed)
+        # a hashmap from an account to its (dirty hashmap, key), for book()
+        self.account_keys: Dict[Any, Tuple[Dict[str, Tuple[Any, ...]], str]] = {}
+        # The higher level operation that book() is called from, if any
+        self.booking: Optional[Tuple[Any, ...]] = None
+
+    def get_dirty(self) -> Dict[Tuple[str, str], Tuple[Any, ...]]:
+        """
+        The accounts booked since the last check, keyed by (kind, key).
+        """
+        out = {}
+        for kind, dirty in (
+            (ASSET, self.dirty_assets),
+            (LIABILITY, self.dirty_liabilities),
+            (GOOD, self.dirty_goods),
+        ):
+            for key, booking in dirty.items():
+                out[kind, key] = booking
+        return out
+
+    def add_account(self, account, contract) -> None:
+        Ledger.add_account(self, account, contract)
+        if account.account_type == AccountType.ASSET:
+            self.account_keys[account] = (self.dirty_assets, contract.ctype)
+        elif account.account_type == AccountType.LIABILITY:
+            self.account_keys[account] = (self.dirty_liabilities, contract.ctype)
+
+    def new_account(self, name: str, account_type: int) -> Account:
+        account = Ledger.new_account(self, name, account_type)
+        # Asset and liability accounts are keyed in add_account(), which knows
+        # their contract type
+        if account_type == AccountType.GOOD:
+            self.account_keys[account] = (self.dirty_goods, name)
+        return account
+
+    def add_asset(self, contract) -> None:
+        Ledger.add_asset(self, contract)
+        self.dirty_assets[contract.ctype] = ("add_asset", contract.ctype)
+
+    def add_liability(self, contract) -> None:
+        Ledger.add_liability(self, contract)
+        self.dirty_liabilities[contract.ctype] = ("add_liability", contract.ctype)
+
+    def create(self, name: str, amount, valuation) -> None:
+        Ledger.create(self, name, amount, valuation)
+        self.dirty_goods[name] = ("create", name, amount, valuation)
+
+    def destroy(self, name: str, amount, valuation=None) -> None:
+        Ledger.destroy(self, name, amount, valuation)
+        self.dirty_goods[name] = ("destroy", name, amount, valuation)
+
+    def revalue_goods(self, name, valuation) -> None:
+        Ledger.revalue_goods(self, name, valuation)
+        self.dirty_goods[name] = ("revalue_goods", name, valuation)
+
+    # pay_liability, sell_asset and pull_funding go through book(), which
+    # marks the accounts with the operation set in self.booking
+
+    def pay_liability(self, amount, loan) -> None:
+        self.booking = ("pay_liability", amount, loan.ctype)
+        try:
+            Ledger.pay_liability(self, amount, loan)
+        finally:
+            self.booking = None
+
+    def sell_asset(self, amount: float, assetType: str) -> None:
+        self.booking = ("sell_asset", amount, assetType)
+        try:
+            Ledger.sell_asset(self, amount, assetType)
+        finally:
+            self.booking = None
+
+    def pull_funding(self, amount, loan) -> None:
+        self.booking = ("pull_funding", amount, loan.ctype)
+        try:
+            Ledger.pull_funding(self, amount, loan)
+        finally:
+            self.booking = None
+
+    def devalue_asset(self, asset, valuationLost: float) -> None:
+        Ledger.devalue_asset(self, asset, valuationLost)
+        self.dirty_assets[asset.ctype] = ("devalue_asset", asset.ctype, valuationLost)
+
+    def appreciate_asset(self, asset, valuationLost: float) -> None:
+        Ledger.appreciate_asset(self, asset, valuationLost)
+        self.dirty_assets[asset.ctype] = ("appreciate_asset", asset.ctype, valuationLost)
+
+    def devalue_liability(self, liability, valuationLost: float) -> None:
+        Ledger.devalue_liability(self, liability, valuationLost)
+        self.dirty_liabilities[liability.ctype] = ("devalue_liability", liability.ctype, valuationLost)
+
+    def appreciate_liability(self, liability, valuationLost) -> None:
+        Ledger.appreciate_liability(self, liability, valuationLost)
+        self.dirty_liabilities[liability.ctype] = ("appreciate_liability", liability.ctype, valuationLost)
+
+    def book(self, debit_account: Account, credit_account: Account, amount: float):
+        Ledger.book(self, debit_account, credit_account, amount)
+        booking = self.booking
+        if booking is None:
+            booking = ("book", debit_account.name, credit_account.name, amount)
+        keys = self.account_keys
+        for account in (debit_account, credit_account):
+            dirty_key = keys.get(account)
+            if dirty_key is not None:
+                dirty_key[0][dirty_key[1]] = booking
+
+    def get_expected_balance(self, kind: str, key: str) -> Optional[float]:
+        """
+        The balance an account should have according to its contracts or the
+        inventory. Returns None if it can't be derived, e.g. for goods other
+        than cash, whose price is only known to the GoodsAccount itself.
+        """
+        if kind == ASSET:
+            out = 0.0
+            for c in self.contracts.all_assets.get(key, ()):
+                out += c.get_valuation("A")
+            return out
+        if kind == LIABILITY:
+            out = 0.0
+            for c in self.contracts.all_liabilities.get(key, ()):
+                out += c.get_valuation("L")
+            return out
+        quantity = self.inventory.get(key, 0.0)
+        if key == "cash":
+            # Use a probe account so that the sign convention of the
+            # GoodsAccount is respected
+            probe = Account(key, AccountType.GOOD)
+            probe.debit(quantity)
+            return probe.balance
+        if abs(quantity) <= eps:
+            return 0.0
+        return None
+
+    def get_actual_balance(self, kind: str, key: str) -> float:
+        accounts: Dict[str, Any] = {
+            ASSET: self.asset_accounts,
+            LIABILITY: self.liability_accounts,
+            GOOD: self.goods_accounts,
+        }[kind]
+        account = accounts.get(key)
+        return 0.0 if account is None else account.balance
+
+    def reconcile(self, sample_rate: Optional[float] = None, tolerance: float = 1e-6) -> List[Mismatch]:
+        """
+        Verify the accounts booked since the last check against their
+        contracts and the inventory.
+        Only a `sample_rate` fraction of the changed accounts is checked; the
+        accounts that are not sampled stay in the queue for the next check.
+        """
+        if sample_rate is None:
+            sample_rate = self.sample_rate
+        mismatches = []
+        for kind, dirty in (
+            (ASSET, self.dirty_assets),
+            (LIABILITY, self.dirty_liabilities),
+            (GOOD, self.dirty_goods),
+        ):
+            for key, booking in list(dirty.items()):
+                if sample_rate < 1.0 and self.rng.random() >= sample_rate:
+                    continue
+                del dirty[key]
+                expected = self.get_expected_balance(kind, key)
+                if expected is None:
+                    continue
+                actual = self.get_actual_balance(kind, key)
+                if abs(actual - expected) > tolerance:
+                    mismatches.append(Mismatch(kind, key, expected, actual, describe(booking)))
+        return mismatches
@@ -0,0 +1,153 @@
+import bisect
+import pickle
+import struct
+from typing import Any, Dict, Iterable, List, Optional
+
+from .accounting import Ledger
+
+KEYFRAME = b"K"
+DELTA = b"D"
+# Every record starts with its kind, its tick and the size of its pickled
+# payload, so that the file can be indexed without unpickling the payloads
+HEADER = struct.Struct("<cqQ")
+
+
+def get_ledger_state(ledger) -> Dict[str, float]:
+    """
+    A flat view of a ledger: "cash" for FastLedger.cash, and "A/<ctype>",
+    "L/<ctype>", "G/<good>" and "I/<good>" for the balances of the asset,
+    liability and goods accounts and for the inventory.
+    """
+    state = {"cash": ledger.cash}
+    if isinstance(ledger, Ledger):
+        for prefix, accounts in (
+            ("A/", ledger.asset_accounts),
+            ("L/", ledger.liability_accounts),
+            ("G/", ledger.goods_accounts),
+        ):
+            for key, account in accounts.items():
+                state[prefix + key] = account.balance
+        inventory = ledger.inventory
+        for name in inventory:
+            state["I/" + name] = inventory.get(name)
+    return state
+
+
+class SnapshotWriter:
+    """
+    Writes the state of every agent's ledger at each tick. A full keyframe
+    is written every `keyframe_interval` ticks; in between, only the
+    (agent, field, new value) deltas from the previous tick are written. A
+    field that disappears has a new value of None.
+    Diffing every agent costs O(all fields) per tick; a model that knows
+    which agents it touched can pass them to write() to only diff those.
+    """
+
+    __slots__ = "agents", "file", "keyframe_interval", "previous", "count"
+
+    def __init__(self, path: str, agents: Iterable[Any], keyframe_interval: int = 100) -> None:
+        self.agents = list(agents)
+        self.file = open(path, "wb")
+        self.keyframe_interval = keyframe_interval
+        self.previous: Dict[str, Dict[str, float]] = {}
+        self.count = 0
+
+    def write(self, tick: int, changed: Optional[Iterable[Any]] = None) -> None:
+        """
+        Write the state at `tick`. If `changed` is given, the ledgers of the
+        other agents are assumed to be unchanged since the previous write.
+        """
+        previous = self.previous
+        if self.count % self.keyframe_interval == 0 or changed is None:
+            agents: Iterable[Any] = self.agents
+        else:
+            agents = changed
+        state = {a.get_name(): get_ledger_state(a.get_ledger()) for a in agents}
+        if self.count % self.keyframe_interval == 0:
+            kind, payload = KEYFRAME, state
+            self.previous = state
+        else:
+            deltas = []
+            for name, fields in state.items():
+                old = previous.get(name)
+                if old is None:
+                    deltas += [(name, field, value) for field, value in fields.items()]
+                    continue
+                for field, value in fields.items():
+                    if old.get(field) != value:
+                        deltas.append((name, field, value))
+                for field in old:
+                    if field not in fields:
+                        deltas.append((name, field, None))
+            kind, payload = DELTA, deltas
+            previous.update(state)
+        data = pickle.dumps(payload, pickle.HIGHEST_PROTOCOL)
+        self.file.write(HEADER.pack(kind, tick, len(data)))
+        self.file.write(data)
+        self.count += 1
+
+    def close(self) -> None:
+        self.file.close()
+
+    def __enter__(self) -> "SnapshotWriter":
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+
+def _read_payload(f) -> Any:
+    _, _, size = HEADER.unpack(f.read(HEADER.size))
+    return pickle.loads(f.read(size))
+
+
+class SnapshotReader:
+    """
+    Rebuilds the state at any tick of a file written by SnapshotWriter, by
+    replaying the deltas on top of the closest preceding keyframe.
+    """
+
+    __slots__ = "path", "ticks", "offsets", "keyframes"
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        # The tick and file offset of every record, and the positions of the
+        # keyframes among them
+        self.ticks: List[int] = []
+        self.offsets: List[int] = []
+        self.keyframes: List[int] = []
+        with open(path, "rb") as f:
+            while True:
+                offset = f.tell()
+                header = f.read(HEADER.size)
+                if len(header) < HEADER.size:
+                    break
+                kind, tick, size = HEADER.unpack(header)
+                if kind == KEYFRAME:
+                    self.keyframes.append(len(self.ticks))
+                self.ticks.append(tick)
+                self.offsets.append(offset)
+                f.seek(size, 1)
+
+    def get_state(self, tick: int) -> Optional[Dict[str, Dict[str, float]]]:
+        """
+        The state of every agent at `tick`, or None if it is before the
+        first snapshot.
+        """
+        end = bisect.bisect_right(self.ticks, tick)
+        k = bisect.bisect_right(self.keyframes, end - 1) - 1
+        if k < 0:
+            return None
+        start = self.keyframes[k]
+        with open(self.path, "rb") as f:
+            f.seek(self.offsets[start])
+            state = _read_payload(f)
+            for _ in range(start + 1, end):
+                deltas = _read_payload(f)
+                for name, field, value in deltas:
+                    fields = state.setdefault(name, {})
+                    if value is None:
+                        fields.pop(field, None)
+                    else:
+                        fields[field] = value
+        return state
@@ -0,0 +1,208 @@
+import io
+import pickle
+from collections import defaultdict
+from typing import Any, Dict, Iterable, List, Tuple
+
+from . import Agent, Simulation
+from .messages import GoodMessage, Message, Obligation
+
+# Tags of the encoded messages
+OBLIGATION = "O"
+GOOD = "G"
+MESSAGE = "M"
+PICKLED = "P"
+# Tags of the references to agents and to the simulation in pickled messages
+AGENT = "agent"
+SIMULATION = "simulation"
+
+
+class _NamePickler(pickle.Pickler):
+    # Agents and the simulation are stored by reference, so that a message
+    # never drags the state of the simulation (open files, ...) with it
+    def persistent_id(self, obj):
+        if isinstance(obj, Agent):
+            return (AGENT, obj.get_name())
+        if isinstance(obj, Simulation):
+            return (SIMULATION,)
+        return None
+
+
+class _NameUnpickler(pickle.Unpickler):
+    def __init__(self, file, simulation: "ReplaySimulation") -> None:
+        super().__init__(file)
+        self.simulation = simulation
+
+    def persistent_load(self, pid):
+        if pid[0] == AGENT:
+            return self.simulation.get_agent(pid[1])
+        return self.simulation
+
+
+def dumps(obj) -> bytes:
+    """
+    Pickle `obj` with the agents and the simulation it refers to replaced by
+    references. Raises a TypeError if `obj` can't be pickled.
+    """
+    f = io.BytesIO()
+    try:
+        _NamePickler(f, pickle.HIGHEST_PROTOCOL).dump(obj)
+    except (pickle.PicklingError, TypeError, AttributeError) as e:
+        raise TypeError("Can't record a %s: %s" % (type(obj).__name__, e)) from e
+    return f.getvalue()
+
+
+def encode(msg) -> Any:
+    """
+    Encode a message so that it only refers to agents by name.
+    """
+    if isinstance(msg, Obligation):
+        return (
+            OBLIGATION,
+            msg.from_.get_name(),
+            msg.to.get_name(),
+            msg.amount,
+            msg.time_to_open,
+            msg.time_to_pay,
+            msg.time_to_receive,
+            msg.fulfilled,
+        )
+    elif isinstance(msg, GoodMessage):
+        return (GOOD, msg.good_name, msg.amount, msg.valuation)
+    elif isinstance(msg, Message):
+        return (MESSAGE, msg.sender.get_name(), msg.topic, dumps(msg.message))
+    elif isinstance(msg, (int, float)):
+        # A cash
+        return msg
+    return (PICKLED, dumps(msg))
+
+
+class TraceRecorder:
+    """
+    Streams every message delivered by Simulation.process_postbox to a trace
+    file, one record per tick of the form (tick, [(recipient name, message)]).
+    Message types other than obligations, goods, messages and cash are
+    pickled with the agents they refer to stored by name; record() raises a
+    TypeError if one can't be pickled, which Simulation.process_postbox
+    logs without interrupting the delivery.
+    """
+
+    __slots__ = "simulation", "file"
+
+    def __init__(self, simulation: Simulation, path: str) -> None:
+        self.simulation = simulation
+        self.file = open(path, "wb")
+        simulation.recorder = self
+
+    def record(self, time: int, postbox: Iterable[Tuple[Any, Any]]) -> None:
+        records = [(recipient.get_name(), encode(msg)) for recipient, msg in postbox]
+        if records:
+            pickle.dump((time, records), self.file, pickle.HIGHEST_PROTOCOL)
+
+    def close(self) -> None:
+        if self.simulation.recorder is self:
+            self.simulation.recorder = None
+        self.file.close()
+
+    def __enter__(self) -> "TraceRecorder":
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+
+def read_trace(path: str, names=None) -> Dict[int, List[Tuple[str, Any]]]:
+    """
+    Load the messages of a trace grouped by tick. If `names` is given, only
+    the messages delivered to those agents are kept.
+    """
+    if names is not None:
+        names = set(names)
+    out: Dict[int, List[Tuple[str, Any]]] = defaultdict(list)
+    with open(path, "rb") as f:
+        while True:
+            try:
+                time, records = pickle.load(f)
+            except EOFError:
+                break
+            if names is None:
+                out[time] += records
+            else:
+                out[time] += [r for r in records if r[0] in names]
+    return out
+
+
+class StubAgent(Agent):
+    """
+    Stands in for an agent that is not replayed. It ignores everything that
+    is sent to it.
+    """
+
+    def receive(self, message) -> None:
+        pass
+
+    def step(self) -> None:
+        pass
+
+
+class ReplaySimulation(Simulation):
+    """
+    Rebuild one agent or a small subset of agents from a trace recorded by
+    TraceRecorder.
+    The model's tick loop is run unchanged, with only the replayed agents
+    created on this simulation and registered with register(). Instead of
+    the live postbox traffic, process_postbox() delivers the messages they
+    received in the recorded run. Every other agent is replaced by a
+    StubAgent.
+    Note that obligations are not shared with the stubs, so an obligation
+    sent by a replayed agent is never fulfilled by its counterparty.
+    """
+
+    def __init__(self, path: str, names: Iterable[str]) -> None:
+        super().__init__()
+        self.trace = read_trace(path, names)
+        self.agents: Dict[str, Agent] = {}
+
+    def register(self, agent: Agent) -> None:
+        self.agents[agent.get_name()] = agent
+
+    def get_agent(self, name: str) -> Agent:
+        agent = self.agents.get(name)
+        if agent is None:
+            agent = StubAgent(name, self)
+            self.agents[name] = agent
+        return agent
+
+    def decode(self, encoded) -> Any:
+        if not isinstance(encoded, tuple):
+            return encoded
+        tag = encoded[0]
+        if tag == OBLIGATION:
+            _, from_, to, amount, time_to_open, time_to_pay, time_to_receive, fulfilled = encoded
+            # Bypass Obligation.__init__, which derives the times from a contract
+            obligation = Obligation.__new__(Obligation)
+            obligation.amount = amount
+            obligation.from_ = self.get_agent(from_)
+            obligation.to = self.get_agent(to)
+            obligation.simulation = self
+            obligation.time_to_open = time_to_open
+            obligation.time_to_pay = time_to_pay
+            obligation.time_to_receive = time_to_receive
+            obligation.fulfilled = fulfilled
+            return obligation
+        elif tag == GOOD:
+            return GoodMessage(encoded[1], encoded[2], encoded[3])
+        elif tag == MESSAGE:
+            return Message(self.get_agent(encoded[1]), encoded[2], self.loads(encoded[3]))
+        elif tag == PICKLED:
+            return self.loads(encoded[1])
+        return encoded
+
+    def loads(self, data: bytes) -> Any:
+        return _NameUnpickler(io.BytesIO(data), self).load()
+
+    def process_postbox(self):
+        # The live traffic is dropped: whatever the replayed agents receive
+        # is already in the trace
+        self.postbox.clear()
+        for name, encoded in self.trace.pop(self.time, ()):
+            self.get_agent(name).receive(self.decode(encoded))
@@ -1,8 +1,52 @@
+import os
+import re
+import tempfile
+
 from setuptools import setup, Extension
+from setuptools.command.build_ext import build_ext
+
+# The version is defined once, in economicsl/__init__.py, which can't be
+# imported before the extensions are built
+with open('economicsl/__init__.py') as f:
+    version = re.search(r'^__version__ = "(.*)"$', f.read(), re.M).group(1)
+
+
+class BuildExt(build_ext):
+    """
+    Build economicsl._valuation with OpenMP only if the compiler supports
+    it, e.g. not with Apple clang. Without OpenMP its loop runs on a single
+    thread, and if it can't be built at all, economicsl.population falls
+    back to numpy.
+    """
+
+    def has_openmp(self, flag):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            source = os.path.join(tmpdir, 'openmp.c')
+            with open(source, 'w') as f:
+                f.write('#include <omp.h>\nint main(void) { return omp_get_max_threads(); }\n')
+            try:
+                objects = self.compiler.compile([source], output_dir=tmpdir, extra_postargs=[flag])
+                self.compiler.link_executable(
+                    objects, os.path.join(tmpdir, 'openmp'), extra_postargs=[flag])
+            except Exception:
+                return False
+        return True
+
+    def build_extensions(self):
+        if self.compiler.compiler_type == 'msvc':
+            compile_args, link_args = ['/openmp'], []
+        else:
+            compile_args, link_args = ['-fopenmp'], ['-fopenmp']
+        if self.has_openmp(compile_args[0]):
+            for ext in self.extensions:
+                if ext.name == 'economicsl._valuation':
+                    ext.extra_compile_args += compile_args
+                    ext.extra_link_args += link_args
+        super().build_extensions()
 
 
 setup(name='economicsl',
-      version='0.2',
+      version=version,
       description='Colorful blue ideas live hostilely',
       url='https://github.com/rht/economicsl',
       author='rhtbot',
@@ -17,9 +61,16 @@ setup(name='economicsl',
           Extension(
               'economicsl.accounting',
               ['economicsl/accounting.py']
+          ),
+          Extension(
+              'economicsl._valuation',
+              ['economicsl/_valuation.pyx'],
+              optional=True
           )
       ],
+      cmdclass={'build_ext': BuildExt},
       setup_requires=['setuptools>=18.0', 'cython'],
+      install_requires=['numpy'],
       package_data={
           'economicsl': ['*.pxd'],
       },
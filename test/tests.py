@@ -1,9 +1,66 @@
+import collections
+import os
+import tempfile
 import unittest
+
+import numpy as np
+
 import economicsl
+from economicsl.accounting import Ledger
+from economicsl import population
+from economicsl.contract import Contract
+from economicsl.messages import AbstractMessage, Obligation, ObligationSchedule
+from economicsl.reconciliation import ReconciledLedger
+from economicsl.trace import TraceRecorder, ReplaySimulation
+from economicsl.fork import run_counterfactuals
+from economicsl.fixedpoint import FixedFastLedger, FixedLedger
+from economicsl.loader import load_balance_sheets
+from economicsl.cache import ResultCache
+from economicsl.snapshot import SnapshotReader, SnapshotWriter, get_ledger_state
+from economicsl.market import CallMarket, clear_call_auction
 
 from give_agent import GiveAgent
 from message_agent import MessageAgent
 
+
+class Loan(Contract):
+    __slots__ = "principal",
+    ctype = "Loan"
+
+    def __init__(self, assetParty, liabilityParty, principal):
+        super().__init__(assetParty, liabilityParty)
+        self.principal = principal
+
+    def get_valuation(self, side):
+        return self.principal
+
+    def get_name(self):
+        return "Loan"
+
+
+class DiscountedLoan(Loan):
+    __slots__ = ()
+
+    # The lender marks the loan down to half of its principal
+    def get_valuation(self, side):
+        return self.principal / 2 if side == "A" else self.principal
+
+
+class Offer(AbstractMessage):
+    def __init__(self, sender, price):
+        self.sender = sender
+        self.price = price
+
+
+class OfferAgent(economicsl.Agent):
+    def __init__(self, name, simulation):
+        super().__init__(name, simulation)
+        self.offers = []
+
+    def receive(self, message):
+        self.offers.append(message)
+
+
 NUM_AGENTS = 15
 ROUNDS = 16
 
@@ -30,6 +87,593 @@ class End2EndTest(unittest.TestCase):
             simulation.process_postbox()
             simulation.advance_time()
 
+    def test_population_revalue_goods(self):
+        ledgers = [Ledger() for _ in range(4)]
+        ledgers[0].create("ball", 2, 5.0)
+        index = population.GoodsIndex(ledgers)
+        # The index follows the bookings made after it was built
+        ledgers[1].create("ball", 3, 5.0)
+        ledgers[1].destroy("ball", 2)
+        ledgers[3].create("ball", 1, 5.0)
+        ledgers[3].destroy("ball", 1)
+        expected = [Ledger() for _ in range(4)]
+        expected[0].create("ball", 2, 5.0)
+        expected[1].create("ball", 3, 5.0)
+        expected[1].destroy("ball", 2)
+        expected[3].create("ball", 1, 5.0)
+        expected[3].destroy("ball", 1)
+        expected_change = 0.0
+        for ledger in expected[:2] + expected[3:]:
+            old = ledger.get_goods_account("ball").balance
+            ledger.revalue_goods("ball", 7.0)
+            expected_change += ledger.inventory.get_good("ball") * 7.0 - old
+
+        change = index.revalue_goods({"ball": 7.0, "cake": 1.0})
+        self.assertAlmostEqual(change, expected_change)
+        for ledger, exp in zip(ledgers, expected):
+            if "ball" in exp.goods_accounts:
+                self.assertEqual(
+                    ledger.get_goods_account("ball").balance,
+                    exp.get_goods_account("ball").balance,
+                )
+        # idle holders are left untouched
+        self.assertNotIn("ball", ledgers[2].goods_accounts)
+
+        # Registering a ledger again doesn't book its changes twice, and the
+        # goods of a ReconciledLedger are revalued through it
+        index.add_ledger(ledgers[0])
+        reconciled = ReconciledLedger()
+        reconciled.create("ball", 1, 5.0)
+        reconciled.reconcile()
+        index.add_ledger(reconciled)
+        plain = Ledger()
+        plain.create("ball", 1, 5.0)
+        index.revalue_goods({"ball": 8.0})
+        for ledger, exp in [(ledgers[0], expected[0]), (reconciled, plain)]:
+            exp.revalue_goods("ball", 8.0)
+            self.assertEqual(
+                ledger.get_goods_account("ball").balance,
+                exp.get_goods_account("ball").balance,
+            )
+        self.assertIn(("G", "ball"), reconciled.get_dirty())
+        self.assertNotIn("ball", ledgers[2].inventory)
+
+    def test_reconcile(self):
+        ledger = ReconciledLedger()
+        loan = Loan(None, None, 10.0)
+        ledger.add_asset(loan)
+        ledger.add_cash(5.0)
+        self.assertEqual(ledger.reconcile(), [])
+        self.assertEqual(ledger.get_dirty(), {})
+
+        # The contract loses valuation but only part of it is booked
+        loan.principal = 6.0
+        ledger.devalue_asset(loan, 3.0)
+        mismatches = ledger.reconcile()
+        self.assertEqual(len(mismatches), 1)
+        self.assertEqual((mismatches[0].kind, mismatches[0].key), ("A", "Loan"))
+        self.assertAlmostEqual(mismatches[0].get_difference(), 1.0)
+        self.assertEqual(mismatches[0].booking, "devalue_asset(Loan, 3.0)")
+
+        # Untouched accounts are not checked again
+        self.assertEqual(ledger.reconcile(), [])
+        ledger.add_cash(1.0)
+        self.assertEqual(ledger.reconcile(sample_rate=0.0), [])
+        self.assertIn(("G", "cash"), ledger.get_dirty())
+
+        # book() marks both accounts with the operation that called it
+        ledger.reconcile()
+        ledger.sell_asset(1.0, "Loan")
+        self.assertEqual(
+            ledger.get_dirty(),
+            {("A", "Loan"): ("sell_asset", 1.0, "Loan"), ("G", "cash"): ("sell_asset", 1.0, "Loan")},
+        )
+
+    def test_trace_replay(self):
+        def run(simulation, agents):
+            for time in range(ROUNDS):
+                for i in range(len(agents) - 1):
+                    agents[i].give(agents[i + 1])
+                for a in agents:
+                    a.step()
+                simulation.process_postbox()
+                simulation.advance_time()
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, "trace.pkl")
+            simulation = economicsl.Simulation()
+            agents = [GiveAgent(str(i), 1, 0, simulation) for i in range(NUM_AGENTS)]
+            agents[0].get_ledger().create("ball", 2, 5.5)
+            with TraceRecorder(simulation, path):
+                run(simulation, agents)
+            self.assertIsNone(simulation.recorder)
+
+            # Replay agent 3 alone, with its neighbours stubbed
+            replay = ReplaySimulation(path, ["3"])
+            agent = GiveAgent("3", 1, 0, replay)
+            replay.register(agent)
+            run(replay, [agent, replay.get_agent("4")])
+        original = agents[3].get_ledger()
+        replayed = agent.get_ledger()
+        self.assertEqual(dict(replayed.inventory), dict(original.inventory))
+        self.assertEqual(
+            replayed.get_goods_account("ball").balance,
+            original.get_goods_account("ball").balance,
+        )
+
+    def test_trace_custom_messages(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, "trace.pkl")
+            simulation = economicsl.Simulation()
+            seller = economicsl.Agent("seller", simulation)
+            buyer = OfferAgent("buyer", simulation)
+            with TraceRecorder(simulation, path):
+                seller.send(buyer, Offer(seller, 3.0))
+                simulation.process_postbox()
+                simulation.advance_time()
+                # A message that can't be recorded is still delivered
+                seller.send(buyer, Offer(seller, lambda: 3.0))
+                with self.assertLogs(level="ERROR"):
+                    simulation.process_postbox()
+            self.assertEqual(len(buyer.offers), 2)
+
+            replay = ReplaySimulation(path, ["buyer"])
+            agent = OfferAgent("buyer", replay)
+            replay.register(agent)
+            for _ in range(2):
+                replay.process_postbox()
+                replay.advance_time()
+        self.assertEqual(len(agent.offers), 1)
+        self.assertIs(agent.offers[0].sender, replay.get_agent("seller"))
+        self.assertEqual(agent.offers[0].price, 3.0)
+
+    def test_aggregate_queries(self):
+        simulation = economicsl.Simulation()
+        lender = economicsl.Agent("lender", simulation)
+        borrowers = [economicsl.Agent(str(i), simulation) for i in range(2)]
+        for i, borrower in enumerate(borrowers):
+            loan = Loan(lender, borrower, 10.0 * (i + 1))
+            lender.add(loan)
+            borrower.add(loan)
+            lender.send_obligation(borrower, Obligation(loan, 1.0 + i, 1))
+            lender.send_obligation(borrower, Obligation(loan, 5.0, 2))
+        ledger = lender.get_ledger()
+        self.assertEqual(ledger.get_asset_valuations_by_type(), {"Loan": 30.0})
+        self.assertEqual(list(ledger.iter_assets()), ledger.get_all_assets())
+        out = {"stale": 1.0}
+        self.assertIs(borrowers[0].get_ledger().get_liability_valuations_by_type(out), out)
+        self.assertEqual(out, {"Loan": 10.0})
+
+        simulation.process_postbox()
+        simulation.advance_time()
+        for a in [lender] + borrowers:
+            a.step()
+        mailbox = borrowers[1].mailbox
+        totals = mailbox.get_obligation_totals()
+        self.assertEqual(totals.matured, mailbox.get_matured_obligations())
+        self.assertEqual(totals.matured, 2.0)
+        self.assertEqual(totals.pending, mailbox.get_all_pending_obligations())
+        self.assertEqual(list(mailbox.iter_matured_obligations()), [mailbox.obligation_inbox[0]])
+        self.assertEqual(mailbox.get_pending_obligations_by_counterparty(), {lender: 7.0})
+
+        for o in lender.get_obligation_outbox():
+            o.set_fulfilled()
+        self.assertEqual(lender.mailbox.get_obligation_totals(totals), totals)
+        self.assertEqual(totals.pending_to_me, 13.0)
+        self.assertEqual(
+            lender.mailbox.get_pending_payments_to_me_by_counterparty(),
+            {borrowers[0]: 6.0, borrowers[1]: 7.0},
+        )
+
+    def test_obligation_schedule(self):
+        simulation = economicsl.Simulation()
+        lender = economicsl.Agent("lender", simulation)
+        borrower = economicsl.Agent("borrower", simulation)
+        loan = Loan(lender, borrower, 10.0)
+        lender.send_obligation_schedule(
+            borrower, ObligationSchedule(loan, [1.0, 1.0, 11.0], [6, 3, 9])
+        )
+        matured = []
+
+        def pay(agent):
+            # Only the next payment has been materialized
+            self.assertLessEqual(len(lender.get_obligation_outbox()), 1)
+            matured.append(agent.mailbox.get_matured_obligations())
+            for o in agent.mailbox.iter_matured_obligations():
+                o.set_fulfilled()
+
+        simulation.add_phase("pay", lambda: pay(borrower), per_agent=False)
+        simulation.run([lender, borrower], 10)
+        self.assertEqual(matured, [0, 0, 0, 1.0, 0, 0, 1.0, 0, 0, 11.0])
+        self.assertEqual(lender.mailbox.obligation_schedules, [])
+
+        # A payment registered too late to be seen matures as soon as it can
+        lender.send_obligation_schedule(borrower, ObligationSchedule(loan, [2.0], [10]))
+        matured.clear()
+        simulation.run([lender, borrower], 3)
+        self.assertEqual(matured, [0, 0, 2.0])
+
+    def test_counterfactuals(self):
+        simulation = economicsl.Simulation()
+        agents = [economicsl.Agent(str(i), simulation) for i in range(4)]
+        for a in agents:
+            a.add_cash(10.0)
+
+        def default(state, i):
+            simulation, agents = state
+            agents[i].alive = False
+            agents[i].add_cash(-10.0)
+            simulation.advance_time()
+            return sum(a.get_cash() for a in agents if a.is_alive()), simulation.get_time()
+
+        results = run_counterfactuals(default, (simulation, agents), range(4), processes=2)
+        self.assertEqual(results, [(30.0, 1)] * 4)
+        # The base state is untouched
+        self.assertEqual(simulation.get_time(), 0)
+        self.assertTrue(all(a.is_alive() and a.get_cash() == 10.0 for a in agents))
+
+    def test_fixed_point_ledger(self):
+        ledger = FixedLedger()
+        for _ in range(10):
+            ledger.add_cash(0.1)
+        ledger.subtract_cash(1.0)
+        self.assertEqual(ledger.inventory.units["cash"], 0)
+        self.assertEqual(ledger.get_cash_account().units, 0)
+        # Banker's rounding at the boundary
+        ledger.add_cash(0.125)
+        self.assertEqual(ledger.inventory.get_cash(), 0.12)
+        with self.assertRaises(economicsl.NotEnoughGoods):
+            ledger.subtract_cash(0.13)
+
+        ledger.create("ball", 3, 0.1)
+        self.assertEqual(ledger.inventory.units["ball"], 300)
+        self.assertEqual(ledger.get_goods_account("ball").units, -30)
+
+        loan = Loan(None, None, 0.1)
+        ledger.add_liability(loan)
+        ledger.pay_liability(0.12, loan)
+        self.assertEqual(ledger.liability_accounts["Loan"].units, -2)
+
+        agent = economicsl.Agent("agent", economicsl.Simulation())
+        agent.main_ledger = FixedFastLedger()
+        for _ in range(10):
+            agent.add_cash(0.1)
+        agent.get_ledger().subtract_cash(1.0)
+        self.assertEqual(agent.get_ledger().units, 0)
+        self.assertEqual(agent.get_cash(), 0.0)
+        agent.add_cash(0.125)
+        self.assertEqual(agent.get_cash(), 0.12)
+
+    def test_pipeline(self):
+        simulation = economicsl.Simulation()
+        agents = [economicsl.Agent(str(i), simulation) for i in range(3)]
+        calls = []
+        simulation.add_phase("observe", calls.append, independent=True)
+        simulation.add_phase(
+            "act",
+            lambda a: calls.append(a.get_name()),
+            independent=True,
+            skip=lambda a: a.get_name() == "1",
+        )
+        simulation.add_phase("clear", lambda: calls.append("clear"), per_agent=False)
+        with self.assertRaises(ValueError):
+            simulation.add_phase("report", per_agent=False)
+        pipeline = simulation.get_pipeline()
+        self.assertEqual(
+            [[phase.name for phase in group] for group in pipeline],
+            [["observe", "act"], ["clear"], ["step"], ["process_postbox"], ["advance_time"]],
+        )
+
+        simulation.run(agents, 2)
+        self.assertEqual(simulation.get_time(), 2)
+        self.assertEqual(
+            calls[:6], [agents[0], "0", agents[1], agents[2], "2", "clear"]
+        )
+        self.assertEqual(len(calls), 12)
+        self.assertEqual(
+            set(simulation.phase_timings),
+            {"observe+act", "clear", "step", "process_postbox", "advance_time"},
+        )
+
+    def test_kill_agent(self):
+        simulation = economicsl.Simulation()
+        simulation.track_exposures()
+        lender = economicsl.Agent("lender", simulation)
+        borrowers = [economicsl.Agent(str(i), simulation) for i in range(2)]
+        loans = [Loan(lender, b, 10.0) for b in borrowers]
+        for loan in loans:
+            lender.add(loan)
+            loan.get_liability_party().add(loan)
+            lender.send_obligation(loan.get_liability_party(), Obligation(loan, 1.0, 2))
+        self.assertEqual(simulation.exposures.get_contracts_of(lender), loans)
+        self.assertEqual(len(simulation.exposures.get_obligations_of(lender)), 2)
+
+        written_down = []
+        simulation.kill_agent(
+            borrowers[0], lambda c, counterparty: written_down.append((c, counterparty))
+        )
+        self.assertFalse(borrowers[0].is_alive())
+        self.assertEqual(written_down, [(loans[0], lender)])
+        # The counterparties' entries are purged right away
+        self.assertEqual(
+            [o.get_from() for o in lender.get_obligation_outbox()], [borrowers[1]]
+        )
+        self.assertEqual(simulation.exposures.get_contracts_of(borrowers[0]), [])
+        self.assertEqual(simulation.exposures.get_contracts_of(lender), loans[1:])
+        self.assertEqual(
+            [o.get_from() for o in simulation.exposures.get_obligations_of(lender)], [borrowers[1]]
+        )
+
+        # The loan to the dead borrower is not written down a second time
+        simulation.kill_agent(
+            lender, lambda c, counterparty: written_down.append((c, counterparty))
+        )
+        self.assertEqual(written_down, [(loans[0], lender), (loans[1], borrowers[1])])
+        self.assertEqual(simulation.exposures.get_contracts_of(borrowers[1]), [])
+        self.assertEqual(simulation.exposures.get_obligations_of(borrowers[1]), [])
+
+    def test_simulation_subclass(self):
+        # A subclass that doesn't call Simulation.__init__
+        class CustomSimulation(economicsl.Simulation):
+            def __init__(self):
+                self.time = 0
+                self.postbox = collections.deque()
+
+        simulation = CustomSimulation()
+        lender, borrower = economicsl.Agent("lender", simulation), economicsl.Agent("borrower", simulation)
+        loan = Loan(lender, borrower, 10.0)
+        lender.add(loan)
+        borrower.add(loan)
+        lender.send_obligation(borrower, Obligation(loan, 1.0, 2))
+        for a in (lender, borrower):
+            a.step()
+        simulation.process_postbox()
+        simulation.kill_agent(borrower)
+        lender.step()
+        self.assertEqual(lender.get_obligation_outbox(), [])
+
+    def test_load_balance_sheets(self):
+        def make_agents(simulation):
+            agents = [economicsl.Agent(str(i), simulation) for i in range(3)]
+            agents[2].main_ledger = Ledger()
+            return agents
+
+        simulation = economicsl.Simulation()
+        simulation.track_exposures()
+        agents = make_agents(simulation)
+        with tempfile.TemporaryDirectory() as tmpdir:
+            for name, column in [
+                ("cash", [1.0, 0.0, 2.0]),
+                ("contract_asset_party", [0, 2, 0, 2]),
+                ("contract_liability_party", [1, 0, 2, 1]),
+                ("contract_ctype", [0, 0, 0, 0]),
+                ("contract_valuation", [5.0, 3.0, 4.0, 2.0]),
+                ("ctypes", ["Loan"]),
+                ("inventory_agent", [2]),
+                ("inventory_good", [0]),
+                ("inventory_amount", [3.0]),
+                ("inventory_valuation", [1.5]),
+                ("goods", ["ball"]),
+            ]:
+                np.save(os.path.join(tmpdir, name + ".npy"), np.array(column))
+            contracts = load_balance_sheets(agents, tmpdir, {"Loan": DiscountedLoan})
+        self.assertEqual(len(contracts), 4)
+
+        # Same balance sheets, built one contract at a time
+        expected = make_agents(economicsl.Simulation())
+        expected[0].add_cash(1.0)
+        expected[2].add_cash(2.0)
+        for a, b, v in [(0, 1, 5.0), (2, 0, 3.0), (0, 2, 4.0), (2, 1, 2.0)]:
+            loan = DiscountedLoan(expected[a], expected[b], v)
+            expected[a].add(loan)
+            expected[b].add(loan)
+        expected[2].get_ledger().create("ball", 3.0, 1.5)
+
+        for agent, exp in zip(agents, expected):
+            ledger, exp_ledger = agent.get_ledger(), exp.get_ledger()
+            self.assertEqual(agent.get_cash(), exp.get_cash())
+            self.assertEqual(ledger.get_asset_valuation_of(Loan), exp_ledger.get_asset_valuation_of(Loan))
+            self.assertEqual(ledger.get_liability_valuation_of(Loan), exp_ledger.get_liability_valuation_of(Loan))
+        ledger, exp_ledger = agents[2].get_ledger(), expected[2].get_ledger()
+        self.assertEqual(ledger.asset_accounts["Loan"].balance, exp_ledger.asset_accounts["Loan"].balance)
+        self.assertEqual(ledger.liability_accounts["Loan"].balance, exp_ledger.liability_accounts["Loan"].balance)
+        self.assertEqual(dict(ledger.inventory), dict(exp_ledger.inventory))
+        self.assertEqual(len(simulation.exposures.get_contracts_of(agents[0])), 3)
+
+    def test_result_cache(self):
+        runs = []
+
+        def simulate(params, seed):
+            runs.append(seed)
+            return [params["n"] * seed] * 100
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            cache = ResultCache(tmpdir)
+            self.assertEqual(cache.run(simulate, {"n": 2}, 1), [2] * 100)
+            self.assertEqual(cache.run(simulate, {"n": 2}, 1), [2] * 100)
+            self.assertEqual(runs, [1])
+            cache.run(simulate, {"n": 2}, 2)
+            self.assertEqual(runs, [1, 2])
+
+            # Only room for one entry: the least recently used one goes
+            size = os.path.getsize(cache.get_path(cache.get_key({"n": 2}, 1)))
+            cache.max_bytes = size
+            key = cache.get_key({"n": 2}, 1)
+            os.utime(cache.get_path(key), (0, 0))
+            cache.evict()
+            self.assertIsNone(cache.get(key))
+            self.assertEqual(cache.get(cache.get_key({"n": 2}, 2)), [4] * 100)
+
+            # Keys only collide for equal parameters
+            self.assertNotEqual(cache.get_key({1: 2}, 0), cache.get_key({"1": 2}, 0))
+            a = np.zeros(10000)
+            b = a.copy()
+            b[5000] = 1.0
+            self.assertEqual(repr(a), repr(b))
+            self.assertNotEqual(cache.get_key({"a": a}, 0), cache.get_key({"a": b}, 0))
+            self.assertNotEqual(cache.get_key({"a": a}, 0), cache.get_key({"a": a.astype(np.float32)}, 0))
+            self.assertEqual(
+                cache.get_key({"x": 1, "y": [1.5, None]}, 0),
+                cache.get_key({"y": [1.5, None], "x": 1}, 0),
+            )
+            with self.assertRaises(TypeError):
+                cache.get_key({"f": object()}, 0)
+
+            # A result that can't be pickled leaves nothing behind
+            with self.assertRaises(Exception):
+                cache.put("unpicklable", lambda: None)
+            self.assertFalse([name for name in os.listdir(tmpdir) if name.endswith(".tmp")])
+            # A corrupt entry is a miss and is removed
+            with open(cache.get_path("corrupt"), "wb") as f:
+                f.write(b"not a pickle")
+            self.assertIsNone(cache.get("corrupt"))
+            self.assertFalse(os.path.exists(cache.get_path("corrupt")))
+
+    def test_snapshots(self):
+        simulation = economicsl.Simulation()
+        agents = [GiveAgent(str(i), 1, 0, simulation) for i in range(NUM_AGENTS)]
+        agents[0].get_ledger().create("ball", 2, 5.5)
+        states = []
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, "snapshots.pkl")
+            with SnapshotWriter(path, agents, keyframe_interval=5) as writer:
+                for time in range(ROUNDS):
+                    for i in range(NUM_AGENTS - 1):
+                        agents[i].give(agents[i + 1])
+                    for a in agents:
+                        a.step()
+                    simulation.process_postbox()
+                    writer.write(simulation.get_time())
+                    states.append({a.get_name(): get_ledger_state(a.get_ledger()) for a in agents})
+                    simulation.advance_time()
+            reader = SnapshotReader(path)
+            self.assertIsNone(reader.get_state(-1))
+            for time in [0, 3, 4, 5, 9, ROUNDS - 1]:
+                self.assertEqual(reader.get_state(time), states[time])
+
+            # Only the agents that are passed as changed are diffed
+            path = os.path.join(tmpdir, "changed.pkl")
+            with SnapshotWriter(path, agents, keyframe_interval=5) as writer:
+                for time in range(7):
+                    agents[time].add_cash(1.0)
+                    writer.write(time, [agents[time]])
+                    states[time] = {a.get_name(): get_ledger_state(a.get_ledger()) for a in agents}
+                    # Not seen by the writer
+                    agents[-1].add_cash(1.0)
+            reader = SnapshotReader(path)
+            last = agents[-1].get_name()
+            self.assertEqual(reader.get_state(4)["3"], states[4]["3"])
+            self.assertEqual(reader.get_state(4)[last], states[0][last])
+            # Until the next keyframe
+            self.assertEqual(reader.get_state(6)[last], states[5][last])
+            self.assertNotEqual(states[5][last], states[0][last])
+
+    def test_call_market(self):
+        price, fills = clear_call_auction(
+            [2, 2, 1, 3, 1], [12, 10, 8, 9, 11], [True, True, True, False, False]
+        )
+        # The volume is 3 at both 9 and 10; the buyers are rationed
+        self.assertEqual(price, 9.5)
+        self.assertEqual(fills.tolist(), [1.5, 1.5, 0, 3, 0])
+
+        simulation = economicsl.Simulation()
+        agents = [GiveAgent(str(i), 1, 100, simulation) for i in range(3)]
+        market = CallMarket()
+        agents[0].buy(market, "teddies", 1, 12)
+        agents[1].buy(market, "teddies", 1, 11)
+        agents[2].sell(market, "teddies", 1, 9)
+        with self.assertRaises(economicsl.NotEnoughGoods):
+            agents[2].sell(market, "teddies", 2, 9)
+        # At 12 demand and supply are balanced
+        self.assertEqual(market.clear(), {"teddies": 12.0})
+        self.assertEqual(market.orders, {})
+        inventories = [a.get_ledger().inventory for a in agents]
+        self.assertEqual([inv.get_good("teddies") for inv in inventories], [2, 1, 0])
+        self.assertEqual([inv.get_good("cash") for inv in inventories], [88, 100, 112])
+
+    def test_call_market_failures(self):
+        simulation = economicsl.Simulation()
+        agents = [GiveAgent(str(i), 1, 5, simulation) for i in range(3)]
+
+        def totals():
+            inventories = [a.get_ledger().inventory for a in agents]
+            return [sum(inv.get_good(g) for inv in inventories) for g in ("teddies", "cash")]
+
+        before = totals()
+        market = CallMarket()
+        # The buy orders are checked against the cash, the sell orders
+        # against the inventory net of the other orders
+        with self.assertRaises(economicsl.NotEnoughGoods):
+            agents[0].buy(market, "teddies", 1, 10.5)
+        agents[0].buy(market, "teddies", 1, 5)
+        with self.assertRaises(economicsl.NotEnoughGoods):
+            agents[0].buy(market, "teddies", 1, 1)
+        agents[1].sell(market, "teddies", 1, 4)
+        with self.assertRaises(economicsl.NotEnoughGoods):
+            agents[1].sell(market, "teddies", 1, 4)
+
+        # The first buyer spends its cash before the market is cleared: only
+        # its orders are rejected, and the teddies are cleared without them
+        agents[2].buy(market, "teddies", 1, 5)
+        agents[0].get_ledger().subtract_cash(5)
+        self.assertEqual(market.clear(), {"teddies": 4.5})
+        self.assertEqual(market.rejected, {agents[0]})
+        self.assertEqual(market.orders, {})
+        inventories = [a.get_ledger().inventory for a in agents]
+        self.assertEqual([inv.get_good("teddies") for inv in inventories], [1, 0, 2])
+        self.assertEqual([inv.get_good("cash") for inv in inventories], [0, 9.5, 0.5])
+        self.assertEqual(totals(), [before[0], before[1] - 5])
+
+        # The seller gives its teddy away before the market is cleared
+        agents[0].add_cash(5)
+        agents[0].buy(market, "teddies", 1, 5)
+        agents[2].sell(market, "teddies", 1, 4)
+        agents[2].get_ledger().destroy("teddies", 2)
+        self.assertEqual(market.clear(), {})
+        self.assertEqual(market.rejected, {agents[2]})
+        self.assertEqual(market.orders, {})
+        self.assertEqual(totals(), [before[0] - 2, before[1]])
+
+    def test_barter(self):
+        simulation = economicsl.Simulation()
+        a, b = GiveAgent("a", 2, 0, simulation), GiveAgent("b", 0, 0, simulation)
+        b.get_ledger().create("ball", 3, 1.0)
+        with self.assertRaises(economicsl.NotEnoughGoods):
+            a.barter(b, "ball", 4, 1.0, "teddies", 1, 100.0)
+        a.barter(b, "ball", 3, 1.0, "teddies", 1, 100.0)
+        self.assertEqual(a.get_ledger().inventory.get_good("ball"), 3)
+        self.assertEqual(a.get_ledger().inventory.get_good("teddies"), 1)
+        self.assertEqual(b.get_ledger().inventory.get_good("teddies"), 1)
+        self.assertEqual(b.get_ledger().inventory.get_good("ball"), 0)
+
+    def test_balance_sheets(self):
+        simulation = economicsl.Simulation()
+        agents = [economicsl.Agent(str(i), simulation) for i in range(4)]
+        agents[3].main_ledger = Ledger()
+        for i, (a, b) in enumerate([(0, 1), (0, 2), (2, 1), (3, 0)]):
+            loan = Loan(agents[a], agents[b], 10.0 * (i + 1))
+            agents[a].add(loan)
+            agents[b].add(loan)
+        for i, a in enumerate(agents):
+            a.add_cash(i)
+        table = population.ValuationTable(a.get_ledger() for a in agents)
+        out = table.valuate()
+        for a, row in zip(agents[:3], out):
+            ledger = a.get_ledger()
+            self.assertEqual(
+                row.tolist(),
+                [
+                    ledger.get_asset_valuation(),
+                    ledger.get_liability_valuation(),
+                    ledger.get_equity_valuation(),
+                ],
+            )
+        self.assertEqual(out[3].tolist(), [43.0, 0.0, 43.0])
+
+        agents[0].get_ledger().get_all_assets()[0].principal = 0.0
+        table.refresh()
+        self.assertEqual(table.valuate()[:, 2].tolist(), [-20.0, -29.0, 12.0, 43.0])
+
     # def test_message(self):
     #     simulation = economicsl.Simulation()
     #     agents = [MessageAgent("0", None, 0 % 2, simulation)]